@@ -0,0 +1,120 @@
+"""CPU cost per added listener guild for the shared stream pipeline.
+
+Serves a generated sine WAV over a local HTTP server, subscribes N fake players to
+the StreamHub and drives each one like discord.py's AudioPlayer (one thread, read()
+every 20 ms, per-player Opus encode when the source is PCM). Compares
+STREAM_OUTPUT_MODE=pcm against the encode-once opus mode.
+
+Usage: python benchmarks/bench_shared_opus.py [--listeners 1,10,50,100] [--seconds 5]
+Requires ffmpeg on PATH and libopus loadable by discord.py.
+"""
+import argparse
+import array
+import functools
+import http.server
+import math
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import wave
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import discord  # noqa: E402
+import bot  # noqa: E402
+
+SAMPLE_RATE = 48000
+FRAME_DELAY = discord.opus.Encoder.FRAME_LENGTH / 1000.0
+
+
+def write_sine_wav(path, seconds):
+    samples = array.array('h', (int(8000 * math.sin(2 * math.pi * 440 * i / SAMPLE_RATE)) for i in range(SAMPLE_RATE)))
+    stereo = array.array('h', (v for v in samples for _ in range(2))).tobytes()
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(2); w.setsampwidth(2); w.setframerate(SAMPLE_RATE)
+        for _ in range(seconds): w.writeframes(stereo)
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args): pass
+
+
+def serve_directory(directory):
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class FakePlayer(threading.Thread):
+    """Mimics discord.player.AudioPlayer: paced read() plus the per-client encode for PCM sources."""
+
+    def __init__(self, source):
+        super().__init__(daemon=True)
+        self.source = source
+        self.encoder = None if source.is_opus() else discord.opus.Encoder()
+        self.stop_event = threading.Event()
+        self.frames = 0
+
+    def run(self):
+        start = time.perf_counter()
+        while not self.stop_event.is_set():
+            data = self.source.read()
+            if not data: break
+            if self.encoder: self.encoder.encode(data, discord.opus.Encoder.SAMPLES_PER_FRAME)
+            self.frames += 1
+            time.sleep(max(0, start + FRAME_DELAY * (self.frames + 1) - time.perf_counter()))
+        self.source.cleanup()
+
+
+def cpu_seconds():
+    # Bot process only: the single ffmpeg per URL is a constant cost and does not change with listener count.
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    return own.ru_utime + own.ru_stime
+
+
+def measure(url, mode, listeners, seconds):
+    bot.STREAM_OUTPUT_MODE = mode
+    url = f'{url}?mode={mode}' # Its own decoder per mode, never one left over from the other mode
+    players = [FakePlayer(bot.stream_hub.subscribe(url)) for _ in range(listeners)]
+    if players[0].source.is_opus() != (mode == 'opus'): sys.exit(f"El decoder no está en modo {mode} (¿libopus no disponible?).")
+    for p in players: p.start()
+    time.sleep(1) # Let ffmpeg and the players settle before sampling
+    cpu_before, wall_before = cpu_seconds(), time.perf_counter()
+    time.sleep(seconds)
+    cpu = cpu_seconds() - cpu_before
+    wall = time.perf_counter() - wall_before
+    for p in players: p.stop_event.set()
+    for p in players: p.join()
+    return 100.0 * cpu / wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--listeners', default='1,10,50,100')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+    counts = [int(n) for n in args.listeners.split(',')]
+    bot.DECODER_LINGER_SECONDS = 0 # Stop released decoders at once, so they don't add CPU to the next measurement
+
+    with tempfile.TemporaryDirectory() as tmp:
+        write_sine_wav(os.path.join(tmp, 'sine.wav'), seconds=int(len(counts) * 2 * (args.seconds + 2)) + 10)
+        server = serve_directory(tmp)
+        url = f'http://127.0.0.1:{server.server_port}/sine.wav'
+        print(f"{'mode':<6}{'listeners':>10}{'cpu %':>10}{'cpu %/listener':>16}")
+        for mode in ('pcm', 'opus'):
+            results = []
+            for n in counts:
+                cpu = measure(url, mode, n, args.seconds)
+                results.append((n, cpu))
+                print(f"{mode:<6}{n:>10}{cpu:>10.1f}{cpu / n:>16.2f}")
+            if len(results) > 1:
+                (n0, c0), (n1, c1) = results[0], results[-1]
+                print(f"{mode:<6} marginal cost per added listener: {(c1 - c0) / (n1 - n0):.3f} % CPU")
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
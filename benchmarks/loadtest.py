@@ -0,0 +1,338 @@
+"""Load test for StreamBot without Discord or network access.
+
+Drives the real ensure_voice_connection_and_play / play_stream_continuous code
+through the reconciler, plus the maintain_voice_connections_task safety-net sweep
+(every SWEEP_INTERVAL seconds instead of FULL_SWEEP_INTERVAL) while recovering
+from the fault, against stand-ins:
+
+- FakeBot with N synthetic guilds, each with a voice channel holding one listener
+- FakeVoiceClient whose player thread consumes AudioSource.read() at the real 20 ms
+  cadence (and Opus-encodes PCM sources, like discord.py's AudioPlayer)
+- a local HTTP radio server streaming an endless MP3 at real time, with injectable
+  stalls and disconnects
+
+For each guild count it reports startup time, CPU, RSS, live ffmpeg processes,
+frame deadline misses and the time for every guild to get audio back after an
+upstream fault.
+
+Usage: python benchmarks/loadtest.py [--guilds 10,100,500] [--stations 4] [--fault disconnect|stall]
+Requires ffmpeg (with libmp3lame) on PATH. libopus is used when discord.py can load it.
+"""
+import argparse
+import asyncio
+import contextlib
+import http.server
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import discord  # noqa: E402
+import bot as streambot  # noqa: E402
+
+FRAME_DELAY = discord.opus.Encoder.FRAME_LENGTH / 1000.0
+CLIP_SECONDS = 10
+
+
+# --- Local radio server ---------------------------------------------------------------
+
+def make_mp3_clip(path):
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-y', '-f', 'lavfi', '-i', f'sine=frequency=440:duration={CLIP_SECONDS}',
+                    '-ac', '2', '-ar', '44100', '-c:a', 'libmp3lame', '-b:a', '128k', path], check=True)
+    with open(path, 'rb') as f: return f.read()
+
+
+class RadioServer:
+    """Serves /station<N>.mp3 as an endless real-time MP3 stream (the clip looped)."""
+
+    def __init__(self, clip):
+        self.clip = clip
+        self.bytes_per_second = len(clip) / CLIP_SECONDS
+        self.stall_until = 0.0
+        self.generation = 0 # Bumped by disconnect_all(); handlers from older generations hang up
+        self.connections = 0
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.0'
+
+            def log_message(self, *args): pass
+
+            def do_GET(self):
+                generation = server.generation
+                server.connections += 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'audio/mpeg')
+                self.end_headers()
+                chunk = int(server.bytes_per_second / 10)
+                pos, sent_at = 0, time.monotonic()
+                try:
+                    while server.generation == generation:
+                        if time.monotonic() < server.stall_until: time.sleep(0.05); continue
+                        data = server.clip[pos:pos + chunk] or server.clip[:chunk]
+                        pos = (pos + len(data)) % len(server.clip)
+                        self.wfile.write(data)
+                        sent_at += 0.1
+                        time.sleep(max(0, sent_at - time.monotonic()))
+                except (BrokenPipeError, ConnectionResetError): pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def url(self, station): return f'http://127.0.0.1:{self.httpd.server_port}/station{station}.mp3'
+
+    def stall(self, seconds): self.stall_until = time.monotonic() + seconds
+
+    def disconnect_all(self): self.generation += 1
+
+    def close(self): self.httpd.shutdown()
+
+
+# --- Discord stand-ins ----------------------------------------------------------------
+
+class FakeMember:
+    def __init__(self, member_id, is_bot=False):
+        self.id = member_id
+        self.bot = is_bot
+
+
+class FakeVoiceChannel(discord.VoiceChannel):
+    # Subclass so ensure_voice_connection_and_play's isinstance check passes; slots are filled by hand.
+    def __init__(self, guild, channel_id):
+        self.guild = guild
+        self.id = channel_id
+        self.name = f'radio-{channel_id}'
+        self.listeners = [FakeMember(channel_id + 1)]
+
+    @property
+    def members(self): return self.listeners
+
+    async def connect(self, **kwargs):
+        vc = FakeVoiceClient(self)
+        self.guild.voice_client = vc
+        return vc
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f'guild-{guild_id}'
+        self.voice_client = None
+        self.system_channel = None
+        self.channel = FakeVoiceChannel(self, guild_id * 10)
+        self.voice_channels = [self.channel]
+
+    def get_channel(self, channel_id): return self.channel if channel_id == self.channel.id else None
+
+
+class FakeVoiceClient:
+    """Stands in for discord.VoiceClient; play() runs an AudioPlayer-like thread."""
+    LATE_THRESHOLD = FRAME_DELAY # A frame handed over more than one period late counts as a deadline miss
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.guild = channel.guild
+        self.source = None
+        self.connected = True
+        self.frames = 0
+        self.audio_frames = 0
+        self.deadline_misses = 0
+        self.last_audio_at = None
+        self._end = None
+        self._thread = None
+
+    def is_connected(self): return self.connected
+    def is_playing(self): return self._thread is not None and self._thread.is_alive() and not self._end.is_set()
+    def is_paused(self): return False
+
+    def play(self, source, *, after=None):
+        if self.is_playing(): raise discord.ClientException('Already playing audio.')
+        self.source = source
+        self._end = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(source, after, self._end), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, end):
+        encoder = None
+        if not source.is_opus() and discord.opus.is_loaded(): encoder = discord.opus.Encoder()
+        start, loops, error = time.perf_counter(), 0, None
+        try:
+            while not end.is_set():
+                data = source.read()
+                if not data: break
+                if encoder: encoder.encode(data, discord.opus.Encoder.SAMPLES_PER_FRAME)
+                loops += 1
+                now = time.perf_counter()
+                if now - (start + FRAME_DELAY * loops) > self.LATE_THRESHOLD: self.deadline_misses += 1
+                self.frames += 1
+                if data != source.decoder.silence:
+                    self.audio_frames += 1
+                    self.last_audio_at = time.monotonic()
+                time.sleep(max(0, start + FRAME_DELAY * (loops + 1) - time.perf_counter()))
+        except Exception as e: error = e
+        finally:
+            end.set()
+            if after: after(error)
+            source.cleanup()
+
+    def stop(self):
+        if self._end: self._end.set()
+
+    async def move_to(self, channel): self.channel = channel
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+        self.connected = False
+        self.guild.voice_client = None
+
+
+class FakeBot:
+    def __init__(self, guilds, loop):
+        self.guilds = guilds
+        self._by_id = {g.id: g for g in guilds}
+        self.loop = loop
+        self.user = FakeMember(1, is_bot=True)
+        self.latency = 0.0
+
+    def get_guild(self, guild_id): return self._by_id.get(guild_id)
+    def get_channel(self, channel_id): return None
+    async def wait_until_ready(self): pass
+
+
+# --- Measurements ----------------------------------------------------------------------
+
+def ffmpeg_children():
+    """(pid, rss_bytes, cpu_seconds) for every live ffmpeg child of this process."""
+    children, me, page = [], os.getpid(), os.sysconf('SC_PAGE_SIZE')
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit(): continue
+        try:
+            with open(f'/proc/{pid}/stat') as f: comm_part, rest = f.read().rsplit(')', 1)
+        except OSError: continue
+        fields = rest.split()
+        if int(fields[1]) != me or not comm_part.endswith('(ffmpeg'): continue
+        children.append((int(pid), int(fields[21]) * page, (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')))
+    return children
+
+
+def own_rss_bytes():
+    with open('/proc/self/statm') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def total_cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    reaped = resource.getrusage(resource.RUSAGE_CHILDREN)
+    live = sum(cpu for _, _, cpu in ffmpeg_children())
+    return own.ru_utime + own.ru_stime + reaped.ru_utime + reaped.ru_stime + live
+
+
+async def wait_for(predicate, timeout):
+    started = time.monotonic()
+    while not predicate():
+        if time.monotonic() - started > timeout: return None
+        await asyncio.sleep(0.05)
+    return time.monotonic() - started
+
+
+SWEEP_INTERVAL = 1.0 # Compressed FULL_SWEEP_INTERVAL, so the sweep runs within the recovery window
+
+
+async def sweep_until(done):
+    # What tasks.loop does with the safety-net sweep, at SWEEP_INTERVAL
+    while not done():
+        await streambot.maintain_voice_connections_task.coro()
+        await asyncio.sleep(SWEEP_INTERVAL)
+
+
+async def run_scenario(server, guild_count, stations, window, fault, fault_seconds, timeout):
+    loop = asyncio.get_running_loop()
+    guilds = [FakeGuild(1000 + i) for i in range(guild_count)]
+    streambot.bot = FakeBot(guilds, loop)
+    streambot.guild_registry.clear()
+    streambot.metrics.__init__()
+    streambot.metrics.collectors.append(streambot.collect_runtime_metrics)
+    for g in guilds:
+        streambot.config_store.update_guild(g.id, channel_id=g.channel.id, channel_name=g.channel.name,
+                                            auto_join_on_startup=True, stream_url=server.url(g.id % stations))
+    streambot.reconciler.start()
+    streambot.decoder_supervisor.start()
+
+    started = time.monotonic()
+    for g in guilds: streambot.reconciler.mark_dirty(g.id) # Startup, as the warm start does: connect and play every configured guild
+    await streambot.reconciler.queue.join()
+    clients = lambda: [g.voice_client for g in guilds if g.voice_client]
+    startup = await wait_for(lambda: len(clients()) == guild_count and all(vc.audio_frames for vc in clients()), timeout)
+    startup = startup if startup is None else time.monotonic() - started
+
+    for vc in clients(): vc.deadline_misses = vc.frames = 0
+    cpu_before, wall_before = total_cpu_seconds(), time.monotonic()
+    await asyncio.sleep(window)
+    cpu = 100.0 * (total_cpu_seconds() - cpu_before) / (time.monotonic() - wall_before)
+    procs = ffmpeg_children()
+    rss = own_rss_bytes() + sum(r for _, r, _ in procs)
+    frames = sum(vc.frames for vc in clients())
+    misses = sum(vc.deadline_misses for vc in clients())
+
+    fault_at = time.monotonic()
+    if fault == 'stall': server.stall(fault_seconds)
+    else: server.disconnect_all()
+    await asyncio.sleep(fault_seconds if fault == 'stall' else 0.5)
+    recovered = lambda: all(vc.last_audio_at and vc.last_audio_at > fault_at + (fault_seconds if fault == 'stall' else 0.5) for vc in clients())
+    sweeper = asyncio.create_task(sweep_until(recovered))
+    recovery = await wait_for(recovered, timeout)
+    sweeper.cancel()
+    recovery = recovery if recovery is None else time.monotonic() - fault_at
+
+    for g in guilds: # Teardown through the same path as !leave
+        status = streambot.guild_registry.get(g.id)
+        if status: status.lifecycle = streambot.STOPPED
+        if g.voice_client: await g.voice_client.disconnect()
+        streambot.config_store.remove_guild(g.id)
+    await wait_for(lambda: not streambot.stream_hub.decoders, timeout=streambot.DECODER_LINGER_SECONDS + 10)
+    ttfa_count, ttfa_mean, ttfa_max = streambot.metrics.summary('streambot_time_to_first_audio_seconds')
+    return {
+        'guilds': guild_count, 'startup': startup, 'cpu': cpu, 'rss_mb': rss / 2 ** 20, 'ffmpeg': len(procs),
+        'miss_per_1k': 1000.0 * misses / frames if frames else 0.0, 'ttfa_mean': ttfa_mean, 'recovery': recovery,
+    }
+
+
+def fmt(value, spec): return 'timeout' if value is None else format(value, spec)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', default='10,100,500', help='Comma-separated guild counts to test')
+    parser.add_argument('--stations', type=int, default=4, help='Distinct stream URLs shared by the guilds')
+    parser.add_argument('--window', type=float, default=10.0, help='Steady-state measurement window in seconds')
+    parser.add_argument('--fault', choices=('disconnect', 'stall'), default='disconnect')
+    parser.add_argument('--fault-seconds', type=float, default=3.0, help='Stall length for --fault stall')
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help="Show the bot's own output")
+    args = parser.parse_args()
+    random.seed(args.seed) # Backoff jitter
+    streambot.log.disabled = not args.verbose # The log listener writes to the real stdout, past redirect_stdout
+
+    # Fake voice connects cost nothing, so don't throttle them like real gateway traffic.
+    streambot.voice_connect_limiter = streambot.RateLimiter(10000, burst=10000)
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, 'w') as devnull:
+        streambot.CONFIG_FILE = os.path.join(tmp, 'config.json')
+        server = RadioServer(make_mp3_clip(os.path.join(tmp, 'clip.mp3')))
+        print(f"{'guilds':>7}{'startup s':>11}{'cpu %':>8}{'rss MB':>9}{'ffmpeg':>8}{'miss/1k':>9}{'ttfa s':>8}{'recovery s':>12}")
+        for count in (int(n) for n in args.guilds.split(',')):
+            with contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+                r = await run_scenario(server, count, args.stations, args.window, args.fault, args.fault_seconds, args.timeout)
+            print(f"{r['guilds']:>7}{fmt(r['startup'], '.2f'):>11}{r['cpu']:>8.1f}{r['rss_mb']:>9.1f}{r['ffmpeg']:>8}"
+                  f"{r['miss_per_1k']:>9.2f}{r['ttfa_mean']:>8.2f}{fmt(r['recovery'], '.2f'):>12}")
+        server.close()
+        await streambot.stream_resolver.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
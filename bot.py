@@ -1,10 +1,33 @@
 import discord
 from discord.ext import commands, tasks
 import os
+import random
 from dotenv import load_dotenv
 import json
 import asyncio
 import shutil # For shutil.which to check for ffmpeg
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+import contextlib
+import heapq
+from collections import defaultdict, deque
+from urllib.parse import urljoin, urlsplit
+import aiohttp # Installed with discord.py
+import math
+import atexit
+import logging
+import logging.handlers
+import io
+import queue
+import signal
+import sys
+import traceback
+try: import fcntl # Cross-process config lock; not available on Windows
+except ImportError: fcntl = None
+import numpy # Batched gain on the shared audio path
 
 load_dotenv()
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
@@ -14,288 +37,2191 @@ FFMPEG_OPTIONS = {
     'options': '-vn',
 }
 CONFIG_FILE = 'config.json'
+CONFIG_FLUSH_DELAY = float(os.getenv("CONFIG_FLUSH_DELAY", "1.0")) # Seconds to coalesce config writes before flushing
+RECONCILE_WORKERS = int(os.getenv("RECONCILE_WORKERS", "4")) # Guilds reconciled concurrently
+VOICE_CONNECTS_PER_SECOND = float(os.getenv("VOICE_CONNECTS_PER_SECOND", "2")) # Each connect/move is a gateway voice state update (120 gateway events / 60 s per shard)
+FULL_SWEEP_INTERVAL = float(os.getenv("FULL_SWEEP_INTERVAL", "300")) # Safety-net sweep over every guild, in seconds
+STREAM_BACKOFF_BASE = float(os.getenv("STREAM_BACKOFF_BASE", "2")) # First retry delay after an upstream failure, in seconds
+STREAM_BACKOFF_MAX = float(os.getenv("STREAM_BACKOFF_MAX", "300")) # Cap for the exponential backoff
+STREAM_BREAKER_THRESHOLD = int(os.getenv("STREAM_BREAKER_THRESHOLD", "5")) # Consecutive failures before a stream's circuit opens
+STREAM_PROBE_GRACE = float(os.getenv("STREAM_PROBE_GRACE", "15")) # How long a woken half-open probe may take to spawn before the next waiting guild gets the slot
+STREAM_HEALTHY_SECONDS = float(os.getenv("STREAM_HEALTHY_SECONDS", "60")) # A decoder that ran this long resets the failure count
+PLAYER_RETRY_SECONDS = 10 # First restart delay after a voice player error while the stream itself is fine (doubles per repeat)
+IDLE_GRACE_SECONDS = float(os.getenv("IDLE_GRACE_SECONDS", "120")) # Suspend playback this long after the last listener leaves (0 disables)
+DECODER_LINGER_SECONDS = float(os.getenv("DECODER_LINGER_SECONDS", "15")) # Keep an unused decoder warm this long before stopping it
+NOTIFY_DEDUPE_SECONDS = float(os.getenv("NOTIFY_DEDUPE_SECONDS", "300")) # Repeats of a notice within this window edit the first message
+NOTIFY_MESSAGES_PER_SECOND = float(os.getenv("NOTIFY_MESSAGES_PER_SECOND", "2")) # Budget for notice sends/edits, well under Discord's global limit
+STARTUP_GUILDS_PER_SECOND = float(os.getenv("STARTUP_GUILDS_PER_SECOND", "5")) # Warm-start ramp: auto-join guilds queued per second
+ACTIVITY_RECORD_INTERVAL = 3600 # Seconds between persisted 'last_active_at' updates for a guild
+SHARED_BUFFER_FRAMES = int(os.getenv("SHARED_BUFFER_FRAMES", "250")) # Ring depth in 20 ms frames per shared stream (250 = 5 s)
+STREAM_PREBUFFER_FRAMES = int(os.getenv("STREAM_PREBUFFER_FRAMES", "25")) # How far each player trails the decoder, absorbs upstream jitter
+STREAM_MAX_GAP_SECONDS = float(os.getenv("STREAM_MAX_GAP_SECONDS", "20")) # Upstream outage bridged with silence before playback ends
+STREAM_OUTPUT_MODE = os.getenv("STREAM_OUTPUT_MODE", "opus").lower() # 'opus': encode once per stream, 'pcm': each VoiceClient encodes
+STREAM_OPUS_BITRATE = int(os.getenv("STREAM_OPUS_BITRATE", "128")) # kbps
+VOLUME_MAX = 200 # Highest !volume level, in percent
+AGC_TARGET_DBFS = float(os.getenv("AGC_TARGET_DBFS", "-20")) # Loudness the optional normalization aims for
+RESOLVER_CACHE_SECONDS = float(os.getenv("RESOLVER_CACHE_SECONDS", "600")) # How long a resolved playlist/redirect is reused
+RESOLVER_NEGATIVE_SECONDS = float(os.getenv("RESOLVER_NEGATIVE_SECONDS", "60")) # How long a failed lookup or mirror is skipped
+FFMPEG_MAX_PROCESSES = int(os.getenv("FFMPEG_MAX_PROCESSES", "0")) # Cap on live ffmpeg processes in this process (0 = no cap)
+FFMPEG_MAX_PER_URL = int(os.getenv("FFMPEG_MAX_PER_URL", "2")) # Cap per stream URL, primary decoder plus standby (0 = no cap)
+FFMPEG_STALL_SECONDS = float(os.getenv("FFMPEG_STALL_SECONDS", "15")) # Watchdog kills an ffmpeg that produced no audio for this long
+STANDBY_DECODERS = int(os.getenv("STANDBY_DECODERS", "0")) # Prewarmed standby decoders for the busiest URLs (0 disables)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) # Prometheus text endpoint at /metrics; 0 disables the listener
+# Sharding (set by launcher.py): this process runs SHARD_IDS out of SHARD_COUNT shards and only manages their guilds.
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) # 0 = unsharded single process
+SHARD_IDS = [int(i) for i in os.getenv("SHARD_IDS", "").split(',') if i.strip()] or (list(range(SHARD_COUNT)) if SHARD_COUNT else [])
+COORDINATOR_SOCKET = os.getenv("COORDINATOR_SOCKET") # Unix socket of launcher.py's coordinator
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower() # 'text', or 'json' for one JSON object per line
+LOG_RATE_BURST = int(os.getenv("LOG_RATE_BURST", "20")) # Copies of one message allowed per LOG_RATE_WINDOW before sampling
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "100")) # Past the burst, 1 in N copies is logged
+LOG_RATE_WINDOW = 10.0
+LOOP_STALL_SECONDS = float(os.getenv("LOOP_STALL_SECONDS", "0.25")) # A loop blocked this long gets its stack logged (0 disables the watchdog)
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_MS", "10")) / 1000 # Sampling period of the on-demand profiler
+PROFILE_DIR = os.getenv("PROFILE_DIR", tempfile.gettempdir()) # Where SIGUSR1 writes profile dumps
+
+
+class RepeatFilter(logging.Filter):
+    """Rate-limits true repeats of a message below ERROR: same template (record.msg, before
+    formatting) for the same guild_id and url. One event across many guilds is not a repeat.
+
+    Each key gets LOG_RATE_BURST records per LOG_RATE_WINDOW seconds; past that only 1 in
+    LOG_SAMPLE_EVERY gets through. The next record let through reports how many were dropped.
+    Attached to the queue handler, so it runs in the caller's thread: a dict lookup under a lock.
+    """
+    MAX_KEYS = 20000
+
+    def __init__(self):
+        super().__init__()
+        self.windows = {} # (template, guild_id, url) -> [window start, records seen, records suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR: return True
+        now = time.monotonic()
+        key = (record.msg, getattr(record, 'guild_id', None), getattr(record, 'url', None))
+        with self._lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= LOG_RATE_WINDOW:
+                if window is None and len(self.windows) >= self.MAX_KEYS: self._prune(now)
+                window = self.windows[key] = [now, 0, window[2] if window else 0]
+            window[1] += 1
+            if window[1] > LOG_RATE_BURST and (window[1] - LOG_RATE_BURST) % max(1, LOG_SAMPLE_EVERY):
+                window[2] += 1
+                return False
+            if window[2]: record.suppressed, window[2] = window[2], 0
+        return True
+
+    def _prune(self, now):
+        # Lock held. Drop finished windows with nothing left to report, or everything if that isn't enough.
+        self.windows = {key: w for key, w in self.windows.items() if now - w[0] < LOG_RATE_WINDOW or w[2]}
+        if len(self.windows) >= self.MAX_KEYS: self.windows.clear()
+
+
+class StructuredFormatter(logging.Formatter):
+    """'time level message key=value...', or one JSON object per line with json_lines=True."""
+    FIELDS = ('guild_id', 'url', 'state', 'suppressed')
+
+    def __init__(self, json_lines=False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record):
+        message = record.getMessage()
+        if record.exc_info: message += '\n' + self.formatException(record.exc_info)
+        fields = {k: getattr(record, k) for k in self.FIELDS if getattr(record, k, None) is not None}
+        if self.json_lines:
+            return json.dumps({'time': self.formatTime(record), 'level': record.levelname, 'message': message, **fields}, default=str, ensure_ascii=False)
+        return f"{self.formatTime(record)} {record.levelname:<7} {message}" + ''.join(f" {k}={v}" for k, v in fields.items())
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # The stock prepare() formats the message in the calling thread; leave that to the listener thread.
+    # Callers only pass immutable values as arguments, so the record is safe to format later.
+    def prepare(self, record): return record
+
+
+log = logging.getLogger('streambot')
+
+def setup_logging():
+    """Routes the 'streambot' logger through a queue; a QueueListener thread formats and writes to stdout."""
+    if log.handlers: return
+    log_queue = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(StructuredFormatter(json_lines=LOG_FORMAT == 'json'))
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+    listener._thread.name = 'log-listener' # Lets the profiler tell it apart
+    atexit.register(listener.stop) # Drains what is still queued
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(RepeatFilter())
+    log.addHandler(handler)
+    log.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    log.propagate = False
+
+setup_logging()
+
+
+class Metrics:
+    """Minimal thread-safe counters and histograms rendered in Prometheus text format.
+
+    Gauges are not stored: render() asks the collectors registered in `collectors` for
+    (name, labels, value) tuples computed from live state at scrape time. Collected names
+    ending in _total are typed as counters (values a collector reads from live counters).
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counters = defaultdict(float) # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> [bucket counts..., sum, count, max]
+        self.help = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels): return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self._lock: self.counters[self._key(name, labels)] += value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None: hist = self.histograms[key] = [0] * len(self.BUCKETS) + [0.0, 0, 0.0]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound: hist[i] += 1
+            hist[-3] += value; hist[-2] += 1; hist[-1] = max(hist[-1], value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observes the duration of the with-block into histogram `name`, also when it raises."""
+        started = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - started, **labels)
+
+    def summary(self, name):
+        """(count, mean, max) over every label set of a histogram."""
+        with self._lock: hists = [h for (n, _), h in self.histograms.items() if n == name]
+        count = sum(h[-2] for h in hists)
+        return count, (sum(h[-3] for h in hists) / count if count else 0.0), max((h[-1] for h in hists), default=0.0)
+
+    def total(self, name):
+        with self._lock: return sum(v for (n, _), v in self.counters.items() if n == name)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs: return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in pairs) + '}'
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, list(h)) for k, h in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed: typed.add(name); lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), hist in histograms:
+            if name not in typed: typed.add(name); lines.append(f'# TYPE {name} histogram')
+            for bound, count in zip(self.BUCKETS, hist):
+                lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {count}')
+            lines.append(f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {hist[-2]}')
+            lines.append(f'{name}_sum{self._labels(labels)} {hist[-3]}')
+            lines.append(f'{name}_count{self._labels(labels)} {hist[-2]}')
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                if name not in typed: typed.add(name); lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+                lines.append(f'{name}{self._labels(sorted(labels.items()))} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
 
 def load_config():
+    started = time.perf_counter()
     try:
         with open(CONFIG_FILE, 'r') as f: config = json.load(f)
     except FileNotFoundError: config = {}
-    except json.JSONDecodeError: config = {}; print(f"Error decoding {CONFIG_FILE}.")
+    except json.JSONDecodeError: config = {}; log.error("Error decoding %s.", CONFIG_FILE)
+    metrics.observe('streambot_config_load_seconds', time.perf_counter() - started)
     return config
 
+_UMASK = os.umask(0); os.umask(_UMASK) # Read once at import: os.umask can only be read by setting it, which isn't thread-safe
+
+def config_file_mode():
+    """Permission bits for a rewritten config.json: the current file's, or the umask default for a new one."""
+    try: return os.stat(CONFIG_FILE).st_mode & 0o7777
+    except OSError: return 0o666 & ~_UMASK
+
 def save_config(config):
+    # Atomic: write to a temp file in the same directory, then rename over the original.
+    started = time.perf_counter()
+    directory = os.path.dirname(os.path.abspath(CONFIG_FILE))
     try:
-        with open(CONFIG_FILE, 'w') as f: json.dump(config, f, indent=4)
-    except IOError: print(f"Error writing to {CONFIG_FILE}.")
+        fd, tmp_path = tempfile.mkstemp(prefix='.config-', suffix='.tmp', dir=directory)
+        try:
+            os.chmod(tmp_path, config_file_mode()) # mkstemp creates it 0600, and the rename would carry that over
+            with os.fdopen(fd, 'w') as f: json.dump(config, f, indent=4); f.flush(); os.fsync(f.fileno())
+            os.replace(tmp_path, CONFIG_FILE)
+        except BaseException:
+            try: os.unlink(tmp_path)
+            except OSError: pass
+            raise
+    except (IOError, OSError): log.error("Error writing to %s.", CONFIG_FILE)
+    metrics.observe('streambot_config_save_seconds', time.perf_counter() - started)
+
+def _config_mtime():
+    try: return os.stat(CONFIG_FILE).st_mtime_ns
+    except OSError: return None
+
+@contextlib.contextmanager
+def config_file_lock():
+    # Serializes read-merge-write of config.json between shard processes.
+    if fcntl is None: yield; return
+    with open(CONFIG_FILE + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try: yield
+        finally: fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def merge_and_save_config(updates, base, known_mtime):
+    """Writes per-guild updates ({guild_id_str: conf or None to delete}).
+
+    If another process rewrote the file since known_mtime, its version is used as the base so
+    that process's guilds are not clobbered. Returns (new_mtime, merged_from_disk).
+    """
+    with config_file_lock():
+        merged_from_disk = _config_mtime() != known_mtime
+        config = load_config() if merged_from_disk else base
+        for guild_id_str, conf in updates.items():
+            if conf is None: config.pop(guild_id_str, None)
+            else: config[guild_id_str] = conf
+        save_config(config)
+        return _config_mtime(), merged_from_disk
+
+class ConfigStore:
+    """Parsed guild configs kept in memory.
+
+    Reads are served from memory; the file is only re-parsed when its mtime changes
+    (checked at most once per second). Writes mark the changed guilds dirty and are coalesced
+    into a single background flush (temp file + rename) run off the event loop. Flushes only
+    write the dirty guilds over the file's current contents, so shard processes sharing the
+    file don't overwrite each other.
+    """
+    MTIME_CHECK_INTERVAL = 1.0
+
+    def __init__(self):
+        self._config = None
+        self._mtime = None
+        self._last_check = 0.0
+        self._dirty = False
+        self._dirty_guilds = set()
+        self._flush_scheduled = False
+        self.on_guild_changed = None # Called with the guild id of every guild whose config changed on an external reload
+
+    def get(self):
+        """Returns the whole config dict. Treat it as read-only; use update_guild/remove_guild to change it."""
+        now = time.monotonic()
+        if self._config is None or (not self._dirty and now - self._last_check >= self.MTIME_CHECK_INTERVAL):
+            self._last_check = now
+            mtime = _config_mtime()
+            if self._config is None or mtime != self._mtime:
+                previous, self._config = self._config, load_config()
+                self._mtime = mtime
+                if previous is not None and self.on_guild_changed:
+                    for guild_id_str in previous.keys() | self._config.keys():
+                        if previous.get(guild_id_str) != self._config.get(guild_id_str): self.on_guild_changed(int(guild_id_str))
+        return self._config
+
+    def get_guild(self, guild_id):
+        return self.get().get(str(guild_id), {})
+
+    def update_guild(self, guild_id, **fields):
+        config = self.get()
+        config[str(guild_id)] = {**config.get(str(guild_id), {}), **fields}
+        self._mark_dirty(guild_id)
+        return config[str(guild_id)]
+
+    def remove_guild(self, guild_id):
+        if self.get().pop(str(guild_id), None) is not None: self._mark_dirty(guild_id)
+
+    def _mark_dirty(self, guild_id):
+        self._dirty = True
+        self._dirty_guilds.add(str(guild_id))
+        if self._flush_scheduled: return # Coalesce with the pending flush
+        try: loop = asyncio.get_running_loop()
+        except RuntimeError: self.flush_sync(); return # No event loop (startup/shutdown): write inline
+        self._flush_scheduled = True
+        loop.call_later(CONFIG_FLUSH_DELAY, lambda: loop.create_task(self.flush()))
+
+    def _take_snapshot(self):
+        # Guild configs are flat, so these copies are enough for the writer thread.
+        updates = {g: (dict(self._config[g]) if g in self._config else None) for g in self._dirty_guilds}
+        base = {guild_id: dict(conf) for guild_id, conf in self._config.items()}
+        self._dirty, self._dirty_guilds = False, set()
+        return updates, base, self._mtime
+
+    def _after_write(self, mtime, merged_from_disk):
+        if self._dirty: return
+        # Our own write must not trigger a reload, unless it merged in another process's changes.
+        self._mtime = None if merged_from_disk else mtime
+        if merged_from_disk: self._last_check = 0.0
+
+    async def flush(self):
+        self._flush_scheduled = False
+        if not self._dirty: return
+        loop = asyncio.get_running_loop()
+        self._after_write(*await loop.run_in_executor(None, merge_and_save_config, *self._take_snapshot()))
+
+    def flush_sync(self):
+        if not self._dirty: return
+        self._after_write(*merge_and_save_config(*self._take_snapshot()))
+
+config_store = ConfigStore()
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.guilds = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+if SHARD_COUNT: bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_ids=SHARD_IDS, shard_count=SHARD_COUNT)
+else: bot = commands.Bot(command_prefix="!", intents=intents)
+
+def owns_guild(guild_id):
+    # Discord routes guild events to shard (guild_id >> 22) % shard_count.
+    return not SHARD_COUNT or (int(guild_id) >> 22) % SHARD_COUNT in SHARD_IDS
 bot.remove_command('help')
 
-active_guilds_playback_status = {} # Stores runtime status, including resolved stream_url
+# Guild lifecycle states
+STOPPED = 'stopped'       # Not supposed to play
+CONNECTING = 'connecting' # Wants to play; (re)connect or stream start pending on the reconciler
+WAITING = 'waiting'       # Wants to play; parked on its stream's circuit breaker until a retry is allowed
+PLAYING = 'playing'       # Audio source attached to the voice client
+SUSPENDED = 'suspended'   # Connected, decoding stopped because nobody is listening
+FAILED = 'failed'         # Connect/start failed; the sweep retries it if the guild auto-joins
+LIFECYCLE_STATES = (PLAYING, CONNECTING, WAITING, SUSPENDED, FAILED, STOPPED)
+
+
+def _indexed_slot(slot):
+    # Property over a slot whose changes must be reflected in the registry's indexes.
+    def set_value(state, value):
+        registry = state.registry
+        live = registry.guilds.get(state.guild_id) is state # Removed states don't touch the indexes
+        if live: registry._unindex(state)
+        setattr(state, slot, value)
+        if live: registry._index(state)
+    return property(lambda state: getattr(state, slot), set_value)
+
+
+class GuildPlaybackState:
+    """Runtime playback state of one guild, owned by a GuildRegistry.
+
+    lifecycle, target_channel_id, stream_url and current_stream_url are indexed by the
+    registry and kept in sync on assignment; the remaining fields are plain slots.
+    """
+    __slots__ = ('registry', 'guild_id', '_lifecycle', '_target_channel_id', '_stream_url', '_current_stream_url',
+                 'voice_client', 'text_channel_for_notif_id', 'listeners', 'idle_timer', 'requested_at', 'player_errors')
+
+    lifecycle = _indexed_slot('_lifecycle')
+    target_channel_id = _indexed_slot('_target_channel_id')
+    stream_url = _indexed_slot('_stream_url') # Resolved URL the guild should play
+    current_stream_url = _indexed_slot('_current_stream_url') # URL actually being played
+
+    def __init__(self, registry, guild_id):
+        self.registry = registry
+        self.guild_id = guild_id
+        self._lifecycle = STOPPED
+        self._target_channel_id = None
+        self._stream_url = None
+        self._current_stream_url = None
+        self.voice_client = None
+        self.text_channel_for_notif_id = None
+        self.listeners = 0
+        self.idle_timer = None
+        self.requested_at = None # perf_counter() of the request, for the time-to-first-audio metric
+        self.player_errors = 0 # Consecutive player errors on a healthy stream, for the restart backoff
+
+    @property
+    def wants_playback(self):
+        return self._lifecycle in (CONNECTING, WAITING, PLAYING, SUSPENDED)
+
+    @property
+    def url(self):
+        return self._current_stream_url or self._stream_url
+
+    def __repr__(self):
+        return f"<GuildPlaybackState guild={self.guild_id} {self._lifecycle} url={self.url!r}>"
+
+
+class GuildRegistry:
+    """Every guild's GuildPlaybackState plus O(1) secondary indexes.
+
+    by_url: stream URL -> ids of guilds that want to play it.
+    by_channel: target voice channel id -> guild id.
+    by_lifecycle: lifecycle state -> guild ids; needing_attention is CONNECTING | FAILED.
+    """
+
+    def __init__(self):
+        self.guilds = {}
+        self.by_url = defaultdict(set)
+        self.by_channel = {}
+        self.by_lifecycle = {state: set() for state in LIFECYCLE_STATES}
+
+    def get(self, guild_id):
+        return self.guilds.get(guild_id)
+
+    def setdefault(self, guild_id):
+        state = self.guilds.get(guild_id)
+        if state is None:
+            state = self.guilds[guild_id] = GuildPlaybackState(self, guild_id)
+            self._index(state)
+        return state
+
+    def remove(self, guild_id):
+        state = self.guilds.get(guild_id)
+        if state is None: return None
+        self._unindex(state)
+        del self.guilds[guild_id]
+        if state.idle_timer: state.idle_timer.cancel(); state.idle_timer = None
+        return state
+
+    def clear(self):
+        for guild_id in list(self.guilds): self.remove(guild_id)
+
+    def __contains__(self, guild_id): return guild_id in self.guilds
+    def __len__(self): return len(self.guilds)
+    def __iter__(self): return iter(list(self.guilds.values()))
+
+    def for_channel(self, channel_id):
+        guild_id = self.by_channel.get(channel_id)
+        return self.guilds.get(guild_id) if guild_id is not None else None
+
+    def in_state(self, lifecycle):
+        return [self.guilds[guild_id] for guild_id in self.by_lifecycle[lifecycle]]
+
+    @property
+    def needing_attention(self):
+        return self.by_lifecycle[CONNECTING] | self.by_lifecycle[FAILED]
+
+    def counts(self):
+        return {state: len(guild_ids) for state, guild_ids in self.by_lifecycle.items()}
+
+    def _index(self, state):
+        self.by_lifecycle[state._lifecycle].add(state.guild_id)
+        if state._target_channel_id is not None: self.by_channel[state._target_channel_id] = state.guild_id
+        if state.url and state.wants_playback: self.by_url[state.url].add(state.guild_id)
+
+    def _unindex(self, state):
+        self.by_lifecycle[state._lifecycle].discard(state.guild_id)
+        if self.by_channel.get(state._target_channel_id) == state.guild_id: del self.by_channel[state._target_channel_id]
+        guild_ids = self.by_url.get(state.url)
+        if guild_ids is not None:
+            guild_ids.discard(state.guild_id)
+            if not guild_ids: del self.by_url[state.url]
+
+guild_registry = GuildRegistry()
+
+def guild_fields(guild_id, url=None):
+    """Structured log fields for a guild: extra=guild_fields(...) adds guild_id, url and lifecycle state."""
+    state = guild_registry.get(guild_id)
+    return {'guild_id': guild_id, 'url': url or (state.url if state else None), 'state': state.lifecycle if state else None}
+
+class StreamBackoff(discord.ClientException):
+    """Raised by StreamHub.subscribe while a stream URL is backing off after upstream failures."""
+
+    def __init__(self, url, retry_in):
+        super().__init__(f"Stream {url} en espera tras fallos, reintento en {retry_in:.0f} s.")
+        self.url = url
+        self.retry_in = retry_in
+
+
+class DecoderLimitReached(discord.ClientException):
+    """Raised by StreamHub.subscribe when FFMPEG_MAX_PROCESSES/FFMPEG_MAX_PER_URL leave no room for another decoder."""
+
+    def __init__(self, url):
+        super().__init__(f"Límite de procesos FFmpeg alcanzado; no se puede iniciar {url}.")
+        self.url = url
+
+
+class StreamCircuitBreaker:
+    """Upstream failure tracking for one stream URL, shared by every guild that plays it.
+
+    closed: spawning is allowed once retry_at has passed (exponential backoff with jitter).
+    open: after STREAM_BREAKER_THRESHOLD consecutive failures nothing spawns until retry_at,
+    then a single waiting guild is woken as the probe (half_open). If it hasn't spawned within
+    STREAM_PROBE_GRACE (it left, was suspended...) the next waiting guild is woken. The probe's
+    first decoded frame closes the circuit and every waiting guild is resumed together.
+    Only touched from the event loop.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.state = 'closed'
+        self.failures = 0
+        self.retry_at = 0.0
+        self.probing = False
+        self.waiting = set() # Guild ids parked until the stream may be retried
+        self._timer = None
+
+    def retry_in(self): return max(0.0, self.retry_at - time.monotonic())
+
+    def can_retry(self):
+        """Whether allow_spawn would let a guild through right now, without taking the probe slot."""
+        if self.state == 'half_open': return not self.probing
+        return self.state == 'closed' and time.monotonic() >= self.retry_at
+
+    def allow_spawn(self):
+        if not self.can_retry(): return False
+        if self.state == 'half_open': self.probing = True
+        return True
+
+    def release_probe(self):
+        """Frees the half_open probe slot after a spawn that failed locally (e.g. the FFmpeg cap), not upstream."""
+        if self.state != 'half_open' or not self.probing: return
+        self.probing = False
+        if self._timer is None: self._timer = bot.loop.call_later(STREAM_PROBE_GRACE, self._on_retry_time)
+
+    def park(self, guild_id):
+        self.waiting.add(guild_id)
+        if self._timer is None: self._schedule()
+
+    def record_success(self):
+        was_failing = self.state != 'closed' or self.failures
+        self.state, self.probing, self.retry_at = 'closed', False, 0.0
+        if self._timer: self._timer.cancel(); self._timer = None
+        if was_failing: log.info("Stream recuperado. Reanudando %d servidor(es).", len(self.waiting), extra={'url': self.url})
+        self._wake(len(self.waiting))
+
+    def record_failure(self, uptime=0.0):
+        if uptime >= STREAM_HEALTHY_SECONDS: self.failures = 0 # It had been healthy; treat this as a fresh outage
+        self.failures += 1
+        delay = min(STREAM_BACKOFF_MAX, STREAM_BACKOFF_BASE * 2 ** (self.failures - 1))
+        self.retry_at = time.monotonic() + random.uniform(delay / 2, delay) # Jitter so different URLs don't retry in lockstep
+        self.probing = False
+        if self.failures >= STREAM_BREAKER_THRESHOLD:
+            if self.state != 'open': log.warning("Circuito abierto tras %d fallos consecutivos.", self.failures, extra={'url': self.url})
+            self.state = 'open'
+        self._schedule()
+
+    def _schedule(self):
+        if self._timer: self._timer.cancel()
+        self._timer = bot.loop.call_later(self.retry_in(), self._on_retry_time)
+
+    def _on_retry_time(self):
+        self._timer = None
+        if self.state == 'open': self.state = 'half_open'
+        if self.state == 'half_open':
+            if self.probing: return # The probe's decoder reports back through record_success/record_failure
+            self._wake(1) # Exactly one guild goes first
+            if self.waiting: self._timer = bot.loop.call_later(STREAM_PROBE_GRACE, self._on_retry_time)
+        elif self.state == 'closed': self._wake(len(self.waiting))
+
+    def _wake(self, count):
+        for _ in range(min(count, len(self.waiting))): reconciler.mark_dirty(self.waiting.pop())
+
+
+UNITY_GAIN = (100, False) # Gain key: (volume percent, loudness normalization on)
+
+def guild_gain(guild_config):
+    """Gain key for a guild from its config.json entry."""
+    return int(guild_config.get('volume', 100)), bool(guild_config.get('normalize_loudness', False))
+
+def scale_pcm(frame, gains):
+    """Scales one s16le frame by every factor in `gains` in a single batched pass; one frame per factor."""
+    samples = numpy.frombuffer(frame, dtype='<i2')
+    scaled = numpy.multiply.outer(numpy.asarray(gains, dtype=numpy.float32), samples)
+    numpy.clip(scaled, -32768, 32767, out=scaled)
+    return [row.tobytes() for row in scaled.astype('<i2')]
+
+def pcm_power(frame):
+    """Mean square sample value of an s16le frame."""
+    samples = numpy.frombuffer(frame, dtype='<i2').astype(numpy.float32)
+    return float(numpy.dot(samples, samples)) / len(samples)
+
+class GainStage:
+    """Turns each decoded PCM frame into one frame per distinct gain key used by a decoder's readers.
+
+    Readers register their key with add()/remove(), so ten guilds at 80 % cost one scaled frame,
+    not ten. Unity frames are passed through untouched. Normalization follows the stream's RMS
+    level (slow attack/release, held through silence) and is shared by every normalized key.
+    """
+    POWER_SMOOTHING = 1 / 150 # Loudness averaged over ~3 s of 20 ms frames
+    GAIN_SMOOTHING = 1 / 25 # Normalization gain moves over ~0.5 s
+    MIN_GAIN, MAX_GAIN = 0.25, 4.0 # -12 dB .. +12 dB of normalization
+    SILENCE_RMS = 32768 * 10 ** (-50 / 20) # Below -50 dBFS the gain is held instead of boosting noise
+    TARGET_RMS = 32768 * 10 ** (AGC_TARGET_DBFS / 20)
+
+    def __init__(self):
+        self.levels = defaultdict(int) # Gain key -> readers using it
+        self.power = None
+        self.normalization = 1.0
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        with self._lock: self.levels[key] += 1
+
+    def remove(self, key):
+        with self._lock:
+            self.levels[key] -= 1
+            if self.levels[key] <= 0: del self.levels[key]
+
+    def apply(self, frame):
+        """Returns {gain key: PCM frame}. Decoder thread only."""
+        with self._lock: keys = list(self.levels) or [UNITY_GAIN] # No readers yet (warming up, standby): unity
+        if any(normalize for _, normalize in keys): self._track_loudness(frame)
+        frames = {UNITY_GAIN: frame} if UNITY_GAIN in keys else {}
+        scaled = [key for key in keys if key != UNITY_GAIN]
+        if scaled:
+            gains = [volume / 100 * (self.normalization if normalize else 1.0) for volume, normalize in scaled]
+            frames.update(zip(scaled, scale_pcm(frame, gains)))
+        return frames
+
+    def _track_loudness(self, frame):
+        power = pcm_power(frame)
+        self.power = power if self.power is None else self.power + (power - self.power) * self.POWER_SMOOTHING
+        rms = math.sqrt(self.power)
+        if rms < self.SILENCE_RMS: return
+        target = min(self.MAX_GAIN, max(self.MIN_GAIN, self.TARGET_RMS / rms))
+        self.normalization += (target - self.normalization) * self.GAIN_SMOOTHING
+
+
+class FrameRing:
+    """Fixed-depth ring of frames addressed by sequence number. The slot list is allocated once."""
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.slots = [None] * depth
+        self.head_seq = 0 # Sequence number of the next frame to be produced
+
+    @property
+    def oldest_seq(self): return max(0, self.head_seq - self.depth)
+
+    def push(self, frame):
+        self.slots[self.head_seq % self.depth] = frame
+        self.head_seq += 1
+
+    def get(self, seq): return self.slots[seq % self.depth]
+
+
+class SharedStreamDecoder:
+    """One ffmpeg process per stream URL; decoded 20 ms frames are kept in a shared FrameRing.
+
+    In opus mode each PCM frame is encoded once here and every subscribed VoiceClient
+    sends the same packet as pass-through audio (like FFmpegOpusAudio, but shared).
+    If ffmpeg exits, it is respawned in place for up to STREAM_MAX_GAP_SECONDS while
+    readers get silence; only then does the decoder finish and playback end.
+    """
+
+    def __init__(self, url, opus=None, breaker=None):
+        self.url = url
+        self.breaker = breaker
+        try: self.loop = asyncio.get_running_loop() # Breaker callbacks are marshalled back onto this loop
+        except RuntimeError: self.loop = None
+        self.started_at = time.monotonic()
+        self.last_frame_at = None
+        self.stopped = False
+        self.failure_recorded = False
+        self.opus = STREAM_OUTPUT_MODE == 'opus' if opus is None else opus
+        self.encoder = None
+        self.encoders = {} # Gain key -> opus encoder; each gain level is its own encoded stream
+        self.gain = GainStage()
+        self.ring = FrameRing(SHARED_BUFFER_FRAMES) # Slots hold {gain key: frame}
+        self.subscribers = 0
+        self.finished = False
+        self.error = None
+        self.process = None
+        self.reconnects = 0
+        self.underruns = 0 # Reads that found no frame and got silence instead
+        self.overruns = 0 # Reads that fell a whole ring behind and had to skip ahead
+        self.failover = None # Set by StreamHub: callable(url) telling whether a prewarmed standby can take over
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def head_seq(self): return self.ring.head_seq
+
+    @property
+    def silence(self): return discord.opus.OPUS_SILENCE if self.opus else b'\x00' * discord.opus.Encoder.FRAME_SIZE
+
+    def start(self):
+        if self.opus:
+            try:
+                self.encoder = discord.opus.Encoder()
+                self.encoder.set_bitrate(STREAM_OPUS_BITRATE)
+                self.encoders[UNITY_GAIN] = self.encoder
+            except discord.opus.OpusNotLoaded:
+                log.warning("libopus no disponible, el stream se compartirá como PCM.", extra={'url': self.url})
+                self.opus = False
+        self._spawn()
+        self._thread = threading.Thread(target=self._run, name=f'stream-decoder:{self.url}', daemon=True)
+        self._thread.start()
+
+    def _spawn(self):
+        args = ['ffmpeg', *shlex.split(FFMPEG_OPTIONS.get('before_options', '')), '-re', '-i', self.url,
+                '-f', 's16le', '-ar', '48000', '-ac', '2', '-loglevel', 'warning',
+                *shlex.split(FFMPEG_OPTIONS.get('options', '')), 'pipe:1']
+        try:
+            self.process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            decoder_supervisor.register(self, self.process)
+        except FileNotFoundError: raise discord.ClientException('ffmpeg was not found.') from None
+        except subprocess.SubprocessError as e: raise discord.ClientException(f'Popen failed: {e.__class__.__name__}: {e}') from e
+
+    def _run(self):
+        attempt = 0
+        try:
+            while True:
+                if self._pump(): attempt = 0 # Got audio from this process, so the next outage starts a fresh backoff
+                if self.process.poll() is None: self.process.kill()
+                self.process.wait()
+                if self.stopped: break
+                if self.failover and self.failover(self.url): break # Readers move to the standby instead of waiting for a respawn
+                gap = time.monotonic() - (self.last_frame_at or self.started_at)
+                if gap >= STREAM_MAX_GAP_SECONDS: break
+                delay = min(STREAM_BACKOFF_BASE * 2 ** attempt, STREAM_MAX_GAP_SECONDS - gap) * random.uniform(0.5, 1)
+                attempt += 1
+                if self._stop_event.wait(delay): break
+                self.reconnects += 1
+                metrics.inc('streambot_decoder_reconnects_total', url=self.url)
+                log.warning("StreamHub: reconectando upstream (intento %d), los oyentes reciben silencio.", attempt, extra={'url': self.url})
+                self._spawn()
+        except Exception as e: self.error = e
+        finally:
+            with self._cond:
+                self.finished = True
+                self._cond.notify_all()
+            if not self.stopped and self.breaker: self._notify(self.record_failure) # Upstream ended or failed on its own
+
+    def _pump(self):
+        """Reads the current ffmpeg process until EOF. Returns whether it produced any frame."""
+        frame_size = discord.opus.Encoder.FRAME_SIZE
+        samples_per_frame = discord.opus.Encoder.SAMPLES_PER_FRAME
+        stdout = self.process.stdout
+        produced = False
+        while True:
+            frame = stdout.read(frame_size)
+            if len(frame) != frame_size: return produced
+            frames = self.gain.apply(frame) # One frame per gain level in use, not per guild
+            if self.opus: # Encode once per gain level for every listener at that level
+                frames = {key: self._encoder(key).encode(pcm, samples_per_frame) for key, pcm in frames.items()}
+                if len(self.encoders) > len(frames):
+                    for key in self.encoders.keys() - frames.keys(): del self.encoders[key]
+            with self._cond:
+                self.ring.push(frames)
+                self._cond.notify_all()
+            self.last_frame_at = time.monotonic()
+            if not produced:
+                produced = True
+                if self.breaker: self._notify(self.breaker.record_success)
+
+    def _encoder(self, key):
+        encoder = self.encoders.get(key)
+        if encoder is None:
+            encoder = self.encoders[key] = discord.opus.Encoder()
+            encoder.set_bitrate(STREAM_OPUS_BITRATE)
+        return encoder
+
+    def record_failure(self):
+        # Runs on the event loop, from the pump's callback or from StreamHub.subscribe, whichever sees the death first.
+        if self.failure_recorded: return
+        self.failure_recorded = True
+        self.breaker.record_failure(time.monotonic() - self.started_at)
+
+    def _notify(self, callback, *args):
+        if self.loop and not self.loop.is_closed(): self.loop.call_soon_threadsafe(callback, *args)
+
+    def start_seq(self, gain=UNITY_GAIN):
+        """Cursor for a new reader: STREAM_PREBUFFER_FRAMES behind the live edge when the ring has them,
+        but not before the first frame decoded at `gain`."""
+        with self._cond:
+            seq = max(self.ring.oldest_seq, self.ring.head_seq - STREAM_PREBUFFER_FRAMES)
+            while seq < self.ring.head_seq and gain not in self.ring.get(seq): seq += 1
+            return seq
+
+    def read_frame(self, seq, primed=True, gain=UNITY_GAIN, fallback=None):
+        """Returns (frame at `gain`, next_seq); frames decoded before `gain` was added are read at `fallback`.
+
+        Silence (cursor not advanced) while the upstream is stalled or reconnecting, or while an
+        unprimed reader waits for STREAM_PREBUFFER_FRAMES to accumulate; b'' once the decoder has ended.
+        """
+        with self._cond:
+            ring = self.ring
+            if seq >= ring.head_seq and not self.finished:
+                self._cond.wait(timeout=discord.opus.Encoder.FRAME_LENGTH / 1000) # Give a late frame one period
+            if ring.head_seq - seq >= ring.depth: # Lapped by the writer: jump back to the prebuffer distance
+                self.overruns += 1
+                seq = max(ring.oldest_seq, ring.head_seq - STREAM_PREBUFFER_FRAMES)
+            if seq >= ring.head_seq:
+                if self.finished: return b'', seq
+                if primed: self.underruns += 1
+                return self.silence, seq
+            if not primed and ring.head_seq - seq < STREAM_PREBUFFER_FRAMES and not self.finished: return self.silence, seq
+            frames = ring.get(seq)
+        frame = frames.get(gain)
+        if frame is None: frame = frames.get(fallback, self.silence) # Never another level's frame (or another encoder's stream)
+        return frame, seq + 1
+
+    def stop(self):
+        self.stopped = True
+        self._stop_event.set()
+        proc = self.process
+        if proc and proc.poll() is None:
+            # No wait here: the decoder thread and the supervisor's watchdog reap it.
+            try: proc.kill()
+            except Exception as e: log.error("Error al detener ffmpeg: %s", e, extra={'url': self.url})
+        with self._cond:
+            self.finished = True
+            self._cond.notify_all()
+
+
+class SharedStreamSource(discord.AudioSource):
+    """Per-guild reader over a SharedStreamDecoder. Cheap: it only holds a cursor into the shared ring.
+
+    A swap to another decoder can be queued with StreamHub.swap; read() switches over at the
+    next frame boundary once the new decoder has STREAM_PREBUFFER_FRAMES buffered. The guild's
+    gain key is registered on every decoder the source reads from. The outcome of a swap is
+    reported to finish_swap on the event loop.
+    """
+
+    def __init__(self, hub, decoder, gain=UNITY_GAIN, guild_id=None):
+        self.hub = hub
+        self.decoder = decoder
+        self.guild_id = guild_id
+        self.gain = gain
+        self.previous_gain = None # Level before the last set_gain, still in the frames decoded before it
+        decoder.gain.add(gain)
+        self.seq = decoder.start_seq(gain)
+        self.primed = decoder.head_seq - self.seq >= STREAM_PREBUFFER_FRAMES # Joining a warm decoder starts instantly
+        self.pending = None # Decoder queued by a hot-swap, already subscribed
+        self.requested_at = None # perf_counter() when playback was requested; set by play_stream_continuous
+        self.superseded = False # Stopped by stop_for_restart: the caller starts the replacement, not after_playing
+        self._released = False
+        self._swap_lock = threading.Lock()
+
+    @property
+    def _current_error(self): return self.decoder.error # Picked up by discord.py's AudioPlayer on EOF
+
+    def queue_swap(self, decoder):
+        with self._swap_lock:
+            released = self._released # release() sets it before draining pending under this lock
+            if not released:
+                previous, self.pending = self.pending, decoder
+                decoder.gain.add(self.gain)
+                if previous: previous.gain.remove(self.gain)
+        if released:
+            self.hub.unsubscribe(decoder)
+            raise discord.ClientException("La reproducción ya terminó.")
+        if previous: self.hub.unsubscribe(previous) # A newer swap replaces one still prebuffering
+
+    def set_gain(self, gain):
+        """Switches this guild to another gain level; takes effect within the prebuffer distance."""
+        with self._swap_lock:
+            previous, self.gain = self.gain, gain
+            self.previous_gain = previous
+            if self._released: return # release() already dropped this source's keys
+            for decoder in (self.decoder, self.pending):
+                if decoder: decoder.gain.add(gain); decoder.gain.remove(previous)
+
+    def read(self):
+        if self._released: return b''
+        if self.pending: self._try_swap()
+        seq = self.seq
+        frame, self.seq = self.decoder.read_frame(seq, self.primed, self.gain, self.previous_gain)
+        if self.seq != seq:
+            self.primed = True
+            if self.requested_at is not None: # First real audio frame handed to the player
+                metrics.observe('streambot_time_to_first_audio_seconds', time.perf_counter() - self.requested_at)
+                self.requested_at = None
+        return frame
+
+    def _try_swap(self):
+        with self._swap_lock:
+            pending = self.pending
+            if pending.finished and pending.head_seq == 0: # New URL never produced audio: keep the old one
+                self.pending = None
+                log.warning("Hot-swap cancelado: el stream no produjo audio.", extra={'url': pending.url})
+                old, completed = pending, False
+            elif pending.head_seq >= STREAM_PREBUFFER_FRAMES or pending.finished:
+                old, self.decoder, self.pending = self.decoder, pending, None
+                self.seq = pending.start_seq(self.gain)
+                self.primed = True
+                completed = True
+                log.info("Hot-swap completado desde %s", old.url, extra={'url': pending.url})
+            else: return # Still prebuffering; keep playing the current decoder
+            old.gain.remove(self.gain)
+        self.hub.unsubscribe(old)
+        if self.guild_id is not None: pending._notify(finish_swap, self.guild_id, pending.url, completed)
+
+    def is_opus(self): return self.decoder.opus
+
+    def cleanup(self): self.hub.release(self)
+
+
+class StreamHub:
+    """Keyed by resolved stream URL: one decoder per unique URL, refcounted by subscribed guilds."""
+
+    def __init__(self):
+        self.decoders = {}
+        self.standbys = {} # Stream URL -> prewarmed decoder with no subscribers, promoted when the primary fails
+        self.breakers = {} # Stream URL -> StreamCircuitBreaker, shared by every guild on that URL
+        self._lock = threading.Lock()
+
+    def breaker(self, url):
+        breaker = self.breakers.get(url)
+        if breaker is None: breaker = self.breakers[url] = StreamCircuitBreaker(url)
+        return breaker
+
+    def subscribe(self, url, guild_id=None, gain=UNITY_GAIN):
+        """Raises StreamBackoff (after parking guild_id on the URL's breaker) if the stream may not be respawned yet."""
+        return SharedStreamSource(self, self._acquire(url, guild_id), gain, guild_id)
+
+    def swap(self, source, url, guild_id=None):
+        """Points a playing source at another URL without stopping it; the new decoder prebuffers in the background."""
+        decoder = self._acquire(url, guild_id)
+        if decoder.opus != source.decoder.opus: # The player can't change encoding mid-stream
+            self.unsubscribe(decoder)
+            raise discord.ClientException("El nuevo stream usa otro formato de salida.")
+        source.queue_swap(decoder)
+
+    def _acquire(self, url, guild_id):
+        with self._lock:
+            decoder = self.decoders.get(url)
+            if decoder is None or decoder.finished: # No decoder yet, or the previous one died: spawn a fresh one
+                if decoder and not decoder.stopped and decoder.breaker: decoder.record_failure()
+                breaker = self.breaker(url)
+                if self.standby_ready(url): decoder = self._promote_standby(url)
+                else:
+                    if not breaker.allow_spawn():
+                        if guild_id is not None: breaker.park(guild_id)
+                        raise StreamBackoff(url, breaker.retry_in())
+                    try:
+                        self._make_room(url)
+                        decoder = SharedStreamDecoder(url, breaker=breaker)
+                        try: decoder.start()
+                        except discord.ClientException: breaker.record_failure(); raise
+                    except Exception: breaker.release_probe(); raise # Otherwise a half-open URL would stay probing forever
+                    metrics.inc('streambot_decoder_spawns_total', url=url)
+                    log.info("StreamHub: decoder iniciado", extra={'url': url})
+                decoder.failover = self.standby_ready
+                self.decoders[url] = decoder
+            decoder.subscribers += 1
+            return decoder
+
+    def _make_room(self, url):
+        # Lock held. While a cap is reached, stop standbys, then lingering decoders nobody listens to.
+        while (scope := decoder_supervisor.at_capacity(url)):
+            same_url = url if scope == 'url' else None
+            candidates = [d for d in self.standbys.values() if same_url in (None, d.url)]
+            if candidates:
+                victim = min(candidates, key=lambda d: len(guild_registry.by_url.get(d.url, ())))
+                del self.standbys[victim.url]
+            else:
+                candidates = [d for d in self.decoders.values() if d.subscribers <= 0 and not d.finished and same_url in (None, d.url)]
+                if not candidates:
+                    metrics.inc('streambot_decoder_limit_rejections_total', scope=scope)
+                    raise DecoderLimitReached(url)
+                victim = candidates[0]
+                del self.decoders[victim.url]
+            log.warning("StreamHub: deteniendo decoder para respetar el límite de procesos FFmpeg (%s).", scope, extra={'url': victim.url})
+            victim.stop()
+
+    def standby_ready(self, url):
+        """Whether url has a standby decoder that produced audio within the last second. Safe from any thread."""
+        standby = self.standbys.get(url)
+        return bool(standby and not standby.finished and standby.last_frame_at and time.monotonic() - standby.last_frame_at < 1.0)
+
+    def _promote_standby(self, url):
+        # Lock held. The standby's ring is already full of live audio, so new readers start primed.
+        decoder = self.standbys.pop(url)
+        decoder.breaker = self.breaker(url)
+        decoder.breaker.record_success() # It is decoding right now: resume guilds parked on this URL
+        metrics.inc('streambot_standby_promotions_total', url=url)
+        log.info("StreamHub: standby promovido a decoder principal", extra={'url': url})
+        bot.loop.call_soon(self.refresh_standbys) # Prewarm a replacement
+        return decoder
+
+    def refresh_standbys(self):
+        """Keeps one standby decoder for each of the STANDBY_DECODERS busiest URLs that are playing. Event loop only."""
+        with self._lock:
+            playing = [url for url, d in self.decoders.items() if d.subscribers > 0 and not d.finished]
+            busiest = set(sorted(playing, key=lambda url: len(guild_registry.by_url.get(url, ())), reverse=True)[:STANDBY_DECODERS])
+            for url, standby in list(self.standbys.items()):
+                if url not in busiest or standby.finished:
+                    del self.standbys[url]
+                    standby.stop()
+            for url in busiest - self.standbys.keys():
+                if self.breaker(url).state != 'closed' or decoder_supervisor.at_capacity(url): continue
+                standby = SharedStreamDecoder(url) # No breaker until promoted: its failures shouldn't hold back the primary
+                try: standby.start()
+                except discord.ClientException as e: log.warning("StreamHub: no se pudo iniciar el standby: %s", e, extra={'url': url}); continue
+                self.standbys[url] = standby
+                log.info("StreamHub: standby precalentado", extra={'url': url})
+
+    def release(self, source):
+        with self._lock:
+            if source._released: return
+            source._released = True
+        with source._swap_lock:
+            pending, source.pending = source.pending, None
+            for decoder in (pending, source.decoder):
+                if decoder: decoder.gain.remove(source.gain)
+        if pending: self.unsubscribe(pending)
+        self.unsubscribe(source.decoder)
+
+    def unsubscribe(self, decoder):
+        with self._lock:
+            decoder.subscribers -= 1
+            if decoder.subscribers > 0: return
+            if DECODER_LINGER_SECONDS > 0 and not decoder.finished:
+                # Keep it warm briefly so a guild resuming (or switching back) skips the spawn and upstream connect.
+                timer = threading.Timer(DECODER_LINGER_SECONDS, self._stop_if_unused, (decoder,))
+                timer.daemon = True
+                timer.start()
+                return
+        self._stop_if_unused(decoder)
+
+    def _stop_if_unused(self, decoder):
+        with self._lock:
+            if decoder.subscribers > 0: return # Someone subscribed again while it lingered
+            if self.decoders.get(decoder.url) is decoder: del self.decoders[decoder.url]
+        decoder.stop() # Last guild left: stop the decoder outside the lock
+        log.info("StreamHub: decoder detenido (sin suscriptores)", extra={'url': decoder.url})
+
+def read_proc_usage(pid):
+    """(rss_bytes, cpu_seconds) of a process from /proc, or None where /proc is unavailable or the process is gone."""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f: stat = f.read()
+        with open(f'/proc/{pid}/statm', 'rb') as f: statm = f.read()
+        fields = stat[stat.rindex(b')') + 2:].split() # The command name may contain spaces; fields start at 'state'
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK') # utime + stime
+        return int(statm.split()[1]) * os.sysconf('SC_PAGE_SIZE'), cpu_seconds
+    except (OSError, ValueError, IndexError, AttributeError): return None
+
+
+class SupervisedProcess:
+    """A decoder's current ffmpeg process and its resource usage as last sampled by the watchdog."""
+    __slots__ = ('decoder', 'process', 'started_at', 'rss', 'cpu_seconds', 'cpu_percent', 'sampled_at')
+
+    def __init__(self, decoder, process):
+        self.decoder = decoder
+        self.process = process
+        self.started_at = time.monotonic()
+        self.rss = 0
+        self.cpu_seconds = 0.0
+        self.cpu_percent = 0.0
+        self.sampled_at = None
+
+
+class DecoderSupervisor:
+    """Bookkeeping for every ffmpeg process spawned by the shared decoders, one record per decoder.
+
+    at_capacity() backs the FFMPEG_MAX_PROCESSES/FFMPEG_MAX_PER_URL caps that StreamHub checks
+    before creating a decoder. A watchdog thread kills processes that produced no audio for
+    FFMPEG_STALL_SECONDS (the decoder then reconnects as after any upstream drop) and leftovers
+    of stopped decoders, reaps exited children and samples RSS/CPU from /proc. With
+    STANDBY_DECODERS > 0 it also refreshes the hub's prewarmed standbys periodically.
+    """
+    WATCHDOG_INTERVAL = 2.0
+    STANDBY_REFRESH_INTERVAL = 30.0
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.records = {} # SharedStreamDecoder -> SupervisedProcess
+        self._lock = threading.Lock()
+        self._thread = None
+        self._standby_task = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watchdog, name='ffmpeg-watchdog', daemon=True)
+            self._thread.start()
+        if STANDBY_DECODERS > 0 and (self._standby_task is None or self._standby_task.done()):
+            self._standby_task = asyncio.create_task(self._refresh_standbys())
+
+    def register(self, decoder, process):
+        """Called by a decoder for every process it spawns, including in-place respawns."""
+        with self._lock: self.records[decoder] = SupervisedProcess(decoder, process)
+
+    def snapshot(self):
+        with self._lock: return list(self.records.values())
+
+    def active(self):
+        # Decoders holding a process slot: running or between respawns. A stopped decoder's process is on its way out.
+        return [r for r in self.snapshot() if not r.decoder.stopped and not r.decoder.finished]
+
+    def running(self):
+        return [r for r in self.snapshot() if r.process.poll() is None]
+
+    def at_capacity(self, url):
+        """'global' or 'url' if one more decoder for url would exceed a cap, otherwise None."""
+        active = self.active()
+        if FFMPEG_MAX_PROCESSES > 0 and len(active) >= FFMPEG_MAX_PROCESSES: return 'global'
+        if FFMPEG_MAX_PER_URL > 0 and sum(1 for r in active if r.decoder.url == url) >= FFMPEG_MAX_PER_URL: return 'url'
+        return None
+
+    def _watchdog(self):
+        while True:
+            time.sleep(self.WATCHDOG_INTERVAL)
+            try: self.check()
+            except Exception: log.exception("Supervisor FFmpeg: error en el watchdog")
+
+    def check(self):
+        now = time.monotonic()
+        for record in self.snapshot():
+            decoder, proc = record.decoder, record.process
+            if proc.poll() is not None: # Exited; poll() reaped it
+                if decoder.stopped or decoder.finished or proc is not decoder.process:
+                    with self._lock:
+                        if self.records.get(decoder) is record: del self.records[decoder]
+                continue
+            if decoder.stopped or decoder.finished:
+                proc.kill() # Outlived its decoder; reaped on a later pass
+                continue
+            if now - max(decoder.last_frame_at or 0.0, record.started_at) > FFMPEG_STALL_SECONDS:
+                log.warning("Supervisor FFmpeg: pid %d sin audio durante %.0f s. Terminando el proceso.", proc.pid, FFMPEG_STALL_SECONDS, extra={'url': decoder.url})
+                metrics.inc('streambot_ffmpeg_watchdog_kills_total', url=decoder.url)
+                proc.kill() # The decoder sees EOF and reconnects or ends
+                continue
+            usage = read_proc_usage(proc.pid)
+            if usage is None: continue
+            rss, cpu_seconds = usage
+            if record.sampled_at is not None and now > record.sampled_at:
+                record.cpu_percent = 100.0 * (cpu_seconds - record.cpu_seconds) / (now - record.sampled_at)
+            record.rss, record.cpu_seconds, record.sampled_at = rss, cpu_seconds, now
+
+    async def _refresh_standbys(self):
+        while True:
+            await asyncio.sleep(self.STANDBY_REFRESH_INTERVAL)
+            try: self.hub.refresh_standbys()
+            except Exception: log.exception("Supervisor FFmpeg: error actualizando standbys")
+
+stream_hub = StreamHub()
+decoder_supervisor = DecoderSupervisor(stream_hub)
+
+
+PLAYLIST_CONTENT_TYPES = {'audio/x-scpls', 'audio/scpls', 'audio/x-mpegurl', 'audio/mpegurl', 'application/x-mpegurl', 'application/vnd.apple.mpegurl'}
+
+def looks_like_playlist(url, content_type=''):
+    return content_type in PLAYLIST_CONTENT_TYPES or urlsplit(url).path.lower().endswith(('.pls', '.m3u', '.m3u8'))
+
+def parse_playlist(text, base_url, declared=True):
+    """Stream URLs listed in a .pls or .m3u playlist, in order.
+
+    None when ffmpeg should open base_url itself: an HLS manifest, or text that doesn't look like a
+    playlist (an HTML page...) unless the URL or content type `declared` one.
+    """
+    text = text.lstrip('\ufeff')
+    if '#EXT-X-' in text: return None
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if lines and lines[0].lower() == '[playlist]':
+        files = []
+        for line in lines:
+            key, _, value = line.partition('=')
+            if key.lower().startswith('file') and key[4:].isdigit(): files.append((int(key[4:]), value.strip()))
+        entries = [value for _, value in sorted(files)]
+    else:
+        entries = [line for line in lines if not line.startswith('#')]
+        is_m3u = lines and lines[0].upper().startswith('#EXTM3U') or entries and all(urlsplit(entry).scheme in ('http', 'https') for entry in entries)
+        if not declared and not is_m3u: return None
+    urls = (urljoin(base_url, entry) for entry in entries)
+    return [url for url in urls if url.startswith(('http://', 'https://'))] # Never hand ffmpeg a local path from a playlist
+
+
+class ResolvedStream:
+    __slots__ = ('mirrors', 'expires_at')
+
+    def __init__(self, mirrors, expires_at):
+        self.mirrors = mirrors
+        self.expires_at = expires_at
+
+
+class StreamResolver:
+    """Turns a configured stream URL into the URL ffmpeg should open.
+
+    Follows redirects, expands .pls/.m3u playlists (nested ones too) into a mirror list and
+    leaves HLS manifests to ffmpeg. Lookups are cached for RESOLVER_CACHE_SECONDS and failed
+    ones for RESOLVER_NEGATIVE_SECONDS, shared by every guild; concurrent lookups of one URL
+    share a single request. Mirrors reported as failed are skipped for RESOLVER_NEGATIVE_SECONDS.
+    Only touched from the event loop.
+    """
+    MAX_PLAYLIST_BYTES = 64 * 1024
+    MAX_DEPTH = 3
+    TIMEOUT = 10
+
+    def __init__(self):
+        self.cache = {} # Configured URL -> ResolvedStream
+        self.failed_lookups = {} # Configured URL -> monotonic time until which it isn't looked up again
+        self.failed_mirrors = {} # Mirror URL -> monotonic time until which it is skipped
+        self.inflight = {} # Configured URL -> Future of the lookup in progress
+        self.session = None
+
+    async def resolve(self, url):
+        """Best mirror to play for url right now. Never raises: without a usable lookup it returns url itself."""
+        mirrors = await self.mirrors(url)
+        now = time.monotonic()
+        for mirror in mirrors:
+            if self.failed_mirrors.get(mirror, 0) <= now: return mirror
+        return min(mirrors, key=lambda m: self.failed_mirrors[m]) # All failed recently: the oldest failure; its breaker paces retries
+
+    async def mirrors(self, url):
+        now = time.monotonic()
+        entry = self.cache.get(url)
+        if entry and entry.expires_at > now: return entry.mirrors
+        if self.failed_lookups.get(url, 0) > now: return [url]
+        future = self.inflight.get(url)
+        if future is None:
+            future = self.inflight[url] = asyncio.ensure_future(self._lookup(url))
+            future.add_done_callback(lambda _: self.inflight.pop(url, None))
+        return await asyncio.shield(future) # One guild giving up doesn't cancel the lookup for the others
+
+    async def close(self):
+        if self.session is not None: await self.session.close()
+
+    def report_failure(self, url, mirror):
+        """Skips mirror for a while. Returns whether url still has another mirror to try."""
+        now = time.monotonic()
+        self.failed_mirrors[mirror] = now + RESOLVER_NEGATIVE_SECONDS
+        entry = self.cache.get(url)
+        return bool(entry) and any(self.failed_mirrors.get(m, 0) <= now for m in entry.mirrors)
+
+    async def _lookup(self, url):
+        started = time.perf_counter()
+        try: mirrors = list(dict.fromkeys(await self._expand(url, self.MAX_DEPTH)))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            log.warning("Resolver: no se pudo resolver (%s: %s). Se usará tal cual.", e.__class__.__name__, e, extra={'url': url})
+            metrics.inc('streambot_resolver_lookups_total', result='error')
+            self.failed_lookups[url] = time.monotonic() + RESOLVER_NEGATIVE_SECONDS
+            return [url]
+        finally: metrics.observe('streambot_resolver_lookup_seconds', time.perf_counter() - started)
+        if not mirrors:
+            log.warning("Resolver: la playlist no contiene streams. Se usará tal cual.", extra={'url': url})
+            mirrors = [url]
+        elif mirrors != [url]: log.info("Resolver: resuelto a %s (%d mirror(s))", mirrors[0], len(mirrors), extra={'url': url})
+        metrics.inc('streambot_resolver_lookups_total', result='ok')
+        self.cache[url] = ResolvedStream(mirrors, time.monotonic() + RESOLVER_CACHE_SECONDS)
+        return mirrors
+
+    async def _expand(self, url, depth):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.TIMEOUT), headers={'User-Agent': 'StreamBot'})
+        async with self.session.get(url, allow_redirects=True) as response:
+            if response.status >= 400: raise ValueError(f"HTTP {response.status}")
+            final_url = str(response.url)
+            content_type = response.content_type.lower()
+            if not looks_like_playlist(final_url, content_type) and not content_type.startswith('text/'):
+                return [final_url] # An audio stream: stop here, ffmpeg opens the final URL without the redirects
+            body = b''
+            while len(body) < self.MAX_PLAYLIST_BYTES and (chunk := await response.content.read(self.MAX_PLAYLIST_BYTES - len(body))): body += chunk
+        entries = parse_playlist(body.decode('utf-8', 'replace'), final_url, declared=looks_like_playlist(final_url, content_type))
+        if entries is None: return [final_url] # HLS manifest, or a text response that isn't a playlist
+        mirrors = []
+        for entry in entries:
+            if depth > 1 and looks_like_playlist(entry):
+                try: mirrors += await self._expand(entry, depth - 1)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e: log.warning("Resolver: entrada %s ignorada: %s", entry, e, extra={'url': url})
+            else: mirrors.append(entry)
+        return mirrors
+
+stream_resolver = StreamResolver()
+
+
+def count_listeners(channel):
+    return sum(1 for m in channel.members if not m.bot)
+
+def update_listeners(guild_id, channel, immediate=False):
+    """Tracks non-bot members in the guild's target channel and suspends/resumes playback accordingly.
+
+    With immediate=True (fresh connect, caller starts playback itself) an empty channel suspends at once
+    instead of after the grace period, and a resume is not queued.
+    """
+    state = guild_registry.get(guild_id)
+    if not state or not state.wants_playback: return
+    listeners = count_listeners(channel)
+    state.listeners = listeners
+    if listeners: record_guild_activity(guild_id)
+    if IDLE_GRACE_SECONDS <= 0: return
+    idle_timer, state.idle_timer = state.idle_timer, None
+    if listeners:
+        if idle_timer: idle_timer.cancel()
+        if state.lifecycle == SUSPENDED:
+            state.lifecycle = CONNECTING
+            state.requested_at = time.perf_counter() # The listener's request, for the time-to-first-audio metric
+            log.info("Oyente en %s (%s). Reanudando reproducción.", channel.name, channel.guild.name, extra=guild_fields(guild_id))
+            if not immediate: reconciler.mark_dirty(guild_id)
+    elif state.lifecycle != SUSPENDED:
+        if immediate: suspend_guild(guild_id)
+        else: state.idle_timer = idle_timer or bot.loop.call_later(IDLE_GRACE_SECONDS, suspend_guild, guild_id)
+
+def record_guild_activity(guild_id):
+    # Persisted (at most hourly) so the warm start after a restart can put recently listened guilds first.
+    if time.time() - config_store.get_guild(guild_id).get('last_active_at', 0) >= ACTIVITY_RECORD_INTERVAL:
+        config_store.update_guild(guild_id, last_active_at=int(time.time()))
+
+def stop_for_restart(voice_client):
+    """Stops the current playback so the caller can start a new one; after_playing won't queue a restart of its own."""
+    if isinstance(voice_client.source, SharedStreamSource): voice_client.source.superseded = True
+    voice_client.stop()
+
+def finish_swap(guild_id, url, completed):
+    """Event loop side of a hot-swap from setstreamurl, called once the new stream played or gave up."""
+    state = guild_registry.get(guild_id)
+    if not state: return
+    if completed:
+        state.current_stream_url = url # Only now is the guild really on the new URL
+        return
+    guild = bot.get_guild(guild_id)
+    channel = (bot.get_channel(state.text_channel_for_notif_id) if state.text_channel_for_notif_id else None) or (guild and guild.system_channel)
+    notifier.notify(channel, f"No se pudo cambiar a <{url}>: el stream no produjo audio. Se reintentará con la URL configurada.")
+    # Stop the old stream: after_playing marks the guild dirty and the reconciler restarts it with the
+    # configured URL, so the dead stream goes through its circuit breaker like any other failure.
+    vc = state.voice_client
+    if vc and vc.is_connected() and vc.is_playing(): vc.stop()
+    else: reconciler.mark_dirty(guild_id)
+
+def suspend_guild(guild_id):
+    state = guild_registry.get(guild_id)
+    if not state or not state.wants_playback or state.lifecycle == SUSPENDED: return
+    state.idle_timer = None
+    state.requested_at = None # A pending request ends here; the resume starts a fresh time-to-first-audio measurement
+    state.lifecycle = SUSPENDED
+    guild = bot.get_guild(guild_id)
+    vc = guild.voice_client if guild else None
+    log.info("Sin oyentes en %s. Reproducción suspendida.", guild.name if guild else guild_id, extra=guild_fields(guild_id))
+    if vc and (vc.is_playing() or vc.is_paused()): vc.stop() # Releases the shared decoder; the voice connection stays up
 
 async def play_stream_continuous(voice_client, stream_url_to_play, guild_id, text_channel_for_notif=None):
-    guild_status = active_guilds_playback_status.get(guild_id)
+    guild_status = guild_registry.get(guild_id)
     if not guild_status:
-        print(f"Guild {guild_id} not in active_guilds_playback_status for play_stream_continuous.")
+        log.warning("Guild not in guild_registry for play_stream_continuous.", extra={'guild_id': guild_id})
+        return
+    if guild_status.lifecycle == SUSPENDED: # No listeners; update_listeners resumes when someone joins
+        guild_status.requested_at = None
         return
 
     if not stream_url_to_play or stream_url_to_play == "YOUR_STREAM_URL_HERE":
         msg = f"Error: URL del stream no configurada o inválida para el servidor {voice_client.guild.name}."
-        print(msg)
-        if text_channel_for_notif:
-            try: await text_channel_for_notif.send(msg)
-            except discord.Forbidden: print(f"No permission to send message in {text_channel_for_notif.name}")
-        guild_status['playing'] = False
+        log.error("URL del stream no configurada o inválida.", extra=guild_fields(guild_id, stream_url_to_play))
+        notifier.notify(text_channel_for_notif, msg)
+        guild_status.lifecycle = FAILED
         return
 
     async def after_playing(error):
-        current_guild_status_after = active_guilds_playback_status.get(guild_id) # Re-fetch status
+        if audio_source.superseded: return # Stopped on purpose by a caller that starts the replacement itself
+        current_guild_status_after = guild_registry.get(guild_id) # Re-fetch status
+        retry_delay = None
         if error:
-            print(f"Error durante la reproducción en {voice_client.guild.name}: {error}")
-            if text_channel_for_notif:
-                try: await text_channel_for_notif.send(f"Error durante la reproducción: `{error}`. Intentando reconectar en 10 segundos...")
-                except discord.Forbidden: pass
-                except discord.HTTPException: pass # Catch other potential send errors
+            metrics.inc('streambot_after_playing_errors_total', guild_id=guild_id)
+            metrics.inc('streambot_stream_errors_total', url=stream_url_to_play)
+            log.warning("Error durante la reproducción en %s: %s", voice_client.guild.name, error, extra=guild_fields(guild_id))
+            if not audio_source.decoder.finished and current_guild_status_after:
+                # The player failed, not the stream, so the breaker won't pace the retries: back off per guild.
+                if time.monotonic() - playing_since >= STREAM_HEALTHY_SECONDS: current_guild_status_after.player_errors = 0
+                retry_delay = min(STREAM_BACKOFF_MAX, PLAYER_RETRY_SECONDS * 2 ** current_guild_status_after.player_errors)
+                current_guild_status_after.player_errors += 1
+            wait = retry_delay if retry_delay is not None else stream_hub.breaker((current_guild_status_after and current_guild_status_after.current_stream_url) or stream_url_to_play).retry_in()
+            notifier.notify(text_channel_for_notif, f"Error durante la reproducción: `{error}`. Intentando reconectar en {wait:.0f} segundos...", key='playback_error')
+        elif current_guild_status_after and current_guild_status_after.lifecycle == SUSPENDED:
+            return # Stopped by suspend_guild, not by the stream
         else:
-            print(f"Stream finalizado/interrumpido en {voice_client.guild.name}. Reiniciando...")
+            log.info("Stream finalizado/interrumpido en %s. Reiniciando...", voice_client.guild.name, extra=guild_fields(guild_id))
+
+        decoder = audio_source.decoder if audio_source else None
+        if decoder and decoder.finished and not decoder.stopped and not stream_hub.standby_ready(decoder.url):
+            # The mirror itself failed: skip it for a while so the restart can use the next one
+            configured_url = (current_guild_status_after and current_guild_status_after.stream_url) or stream_url_to_play
+            if stream_resolver.report_failure(configured_url, decoder.url): log.info("Mirror %s falló; se probará el siguiente.", decoder.url, extra=guild_fields(guild_id, configured_url))
 
-        if not voice_client.is_connected() or not current_guild_status_after or not current_guild_status_after.get('playing'):
-            print(f"Playback detenido o bot desconectado de {voice_client.guild.name}. No se reinicia automáticamente.")
-            if current_guild_status_after: current_guild_status_after['playing'] = False
+        if not voice_client.is_connected() or not current_guild_status_after or not current_guild_status_after.wants_playback:
+            log.info("Playback detenido o bot desconectado de %s. No se reinicia automáticamente.", voice_client.guild.name, extra=guild_fields(guild_id))
+            if current_guild_status_after: current_guild_status_after.lifecycle = STOPPED
             return
 
-        await asyncio.sleep(10)
-        if voice_client.is_connected() and current_guild_status_after.get('playing'):
+        if voice_client.is_connected() and current_guild_status_after.wants_playback:
             # --- Modification Start ---
-            guild_status_for_retry = active_guilds_playback_status.get(guild_id)
+            guild_status_for_retry = guild_registry.get(guild_id)
             if not guild_status_for_retry:
-                print(f"Error en retry: No se encontró estado para guild {guild_id}. No se puede reintentar.")
-                if text_channel_for_notif:
-                    try: await text_channel_for_notif.send("Error interno: No se encontró el estado del servidor para reintentar la reproducción.")
-                    except discord.Forbidden: pass
+                log.error("Error en retry: No se encontró estado para el guild. No se puede reintentar.", extra={'guild_id': guild_id})
+                notifier.notify(text_channel_for_notif, "Error interno: No se encontró el estado del servidor para reintentar la reproducción.")
                 return
 
-            latest_stream_url = guild_status_for_retry.get('current_stream_url')
+            latest_stream_url = guild_status_for_retry.current_stream_url
 
             if not latest_stream_url or latest_stream_url == "YOUR_STREAM_URL_HERE":
-                error_msg = f"Error en retry: URL de stream inválida o no configurada para {voice_client.guild.name} (URL: '{latest_stream_url}'). No se puede reintentar."
-                print(error_msg)
-                if text_channel_for_notif:
-                    try: await text_channel_for_notif.send("Error: La URL del stream no está configurada o es inválida. No se puede reintentar la reproducción.")
-                    except discord.Forbidden: pass
-                current_guild_status_after['playing'] = False # Ensure we don't try to play a bad URL again
+                log.error("Error en retry: URL de stream inválida o no configurada para %s. No se puede reintentar.", voice_client.guild.name, extra=guild_fields(guild_id, latest_stream_url))
+                notifier.notify(text_channel_for_notif, "Error: La URL del stream no está configurada o es inválida. No se puede reintentar la reproducción.")
+                current_guild_status_after.lifecycle = STOPPED # Ensure we don't try to play a bad URL again
                 return
 
-            print(f"Reintentando reproducir stream con URL actualizada ({latest_stream_url}) en {voice_client.guild.name}")
-            bot.loop.create_task(play_stream_continuous(voice_client, latest_stream_url, guild_id, text_channel_for_notif))
+            metrics.inc('streambot_guild_restarts_total', guild_id=guild_id)
+            metrics.inc('streambot_stream_restarts_total', url=latest_stream_url)
+            log.info("Reintentando reproducir stream con URL actualizada en %s", voice_client.guild.name, extra=guild_fields(guild_id, latest_stream_url))
+            current_guild_status_after.lifecycle = CONNECTING
+            reconciler.mark_dirty(guild_id, delay=retry_delay) # The reconciler restarts playback (or reconnects) with the latest URL
             # --- Modification End ---
         else:
-            print(f"No se reinicia el stream en {voice_client.guild.name}, estado cambió o desconectado.")
+            log.info("No se reinicia el stream en %s, estado cambió o desconectado.", voice_client.guild.name, extra=guild_fields(guild_id))
 
+    audio_source = None
+    playing_since = None
     try:
+        play_url = await stream_resolver.resolve(stream_url_to_play) # Playlist/redirect expanded to a mirror, cached across guilds
+        if not guild_status.wants_playback or guild_status.lifecycle == SUSPENDED: # Changed while resolving
+            guild_status.requested_at = None
+            return
+
         if not voice_client.is_connected():
-            print(f"Voice client para {voice_client.guild.name} no conectado al inicio de play_stream_continuous.")
-            guild_status['playing'] = False
+            log.warning("Voice client para %s no conectado al inicio de play_stream_continuous.", voice_client.guild.name, extra=guild_fields(guild_id))
+            guild_status.lifecycle = FAILED
             # Rely on maintain_voice_connections_task to re-establish connection
             return
 
-        if voice_client.is_playing() or voice_client.is_paused(): voice_client.stop(); await asyncio.sleep(0.5)
+        if voice_client.is_playing() or voice_client.is_paused(): stop_for_restart(voice_client); await asyncio.sleep(0.5)
+        if voice_client.is_playing() or voice_client.is_paused(): return # Another task started playback while we waited
 
-        audio_source = discord.FFmpegPCMAudio(stream_url_to_play, **FFMPEG_OPTIONS)
-        voice_client.play(audio_source, after=lambda e: asyncio.run_coroutine_threadsafe(after_playing(e), bot.loop))
-        print(f"Stream iniciado en {voice_client.channel.name} ({voice_client.guild.name}) con URL: {stream_url_to_play}")
-        guild_status['playing'] = True
-        guild_status['current_stream_url'] = stream_url_to_play # Store the actual URL being played
+        audio_source = stream_hub.subscribe(play_url, guild_id, guild_gain(config_store.get_guild(guild_id))) # Shared decoder per URL
+        audio_source.requested_at, guild_status.requested_at = guild_status.requested_at or time.perf_counter(), None
+        try: voice_client.play(audio_source, after=lambda e: asyncio.run_coroutine_threadsafe(after_playing(e), bot.loop))
+        except Exception: audio_source.cleanup(); raise # Don't leak the subscription if play() refuses the source
+        playing_since = time.monotonic()
+        log.info("Stream iniciado en %s (%s)", voice_client.channel.name, voice_client.guild.name, extra=guild_fields(guild_id, play_url))
+        guild_status.current_stream_url = play_url # Store the actual URL being played
+        guild_status.lifecycle = PLAYING
+    except StreamBackoff as e:
+        log.info("%s (%s)", e, voice_client.guild.name, extra=guild_fields(guild_id, e.url))
+        if stream_resolver.report_failure(stream_url_to_play, e.url): # Another mirror is available: try it now
+            guild_status.lifecycle = CONNECTING
+            reconciler.mark_dirty(guild_id)
+        else: guild_status.lifecycle = WAITING # Parked on the stream's breaker; it marks this guild dirty when the stream may be retried
     except discord.ClientException as e:
         msg = f"Error de cliente (FFmpeg/URL?) al reproducir en {voice_client.guild.name}: {e}."
-        print(msg)
-        if text_channel_for_notif:
-            try: await text_channel_for_notif.send(msg)
-            except discord.Forbidden: pass
-        guild_status['playing'] = False
+        log.error("Error de cliente (FFmpeg/URL?) al reproducir en %s: %s", voice_client.guild.name, e, extra=guild_fields(guild_id, stream_url_to_play))
+        notifier.notify(text_channel_for_notif, msg)
+        guild_status.lifecycle = FAILED
     except Exception as e:
         msg = f"Error inesperado al iniciar stream en {voice_client.guild.name}: {e}"
-        print(msg)
-        if text_channel_for_notif:
-            try: await text_channel_for_notif.send(msg)
-            except discord.Forbidden: pass
-        guild_status['playing'] = False
+        log.exception("Error inesperado al iniciar stream en %s", voice_client.guild.name, extra=guild_fields(guild_id, stream_url_to_play))
+        notifier.notify(text_channel_for_notif, msg)
+        guild_status.lifecycle = FAILED
 
 async def ensure_voice_connection_and_play(guild_id: int, target_channel_id: int, text_channel_for_notif=None):
     guild = bot.get_guild(guild_id)
     if not guild:
-        if guild_id in active_guilds_playback_status: del active_guilds_playback_status[guild_id]
+        guild_registry.remove(guild_id)
         return
 
     voice_channel = guild.get_channel(target_channel_id)
     if not voice_channel or not isinstance(voice_channel, discord.VoiceChannel):
-        if guild_id in active_guilds_playback_status: del active_guilds_playback_status[guild_id]
-        print(f"Canal de voz {target_channel_id} no encontrado en {guild.name}.")
+        guild_registry.remove(guild_id)
+        log.warning("Canal de voz %s no encontrado en %s.", target_channel_id, guild.name, extra={'guild_id': guild_id})
         return
 
     # Determine the stream URL: Guild-specific from config.json, or global fallback
-    config = load_config()
-    guild_specific_config = config.get(str(guild_id), {})
+    guild_specific_config = config_store.get_guild(guild_id)
     stream_url_to_use = guild_specific_config.get('stream_url', RADIO_STREAM_URL)
 
-    # Update active_guilds_playback_status with the resolved URL and intent to play
-    if guild_id not in active_guilds_playback_status: active_guilds_playback_status[guild_id] = {}
-    status = active_guilds_playback_status[guild_id]
-    status.update({
-        'target_channel_id': target_channel_id,
-        'stream_url': stream_url_to_use, # Store the resolved URL
-        'playing': True # Set intent to play
-    })
+    # Update the guild's state with the resolved URL and intent to play
+    status = guild_registry.setdefault(guild_id)
+    status.target_channel_id = target_channel_id
+    status.stream_url = stream_url_to_use # Store the resolved URL
+    status.lifecycle = CONNECTING # Set intent to play
 
     notification_channel = text_channel_for_notif or guild.system_channel
+    status.requested_at = time.perf_counter() # Start of the time-to-first-audio measurement
 
     vc = guild.voice_client
     try:
         if vc and vc.is_connected():
             if vc.channel.id != target_channel_id:
-                await vc.move_to(voice_channel) # Move if in wrong channel
-            status['voice_client'] = vc
+                with metrics.timer('streambot_reconcile_step_seconds', step='rate_limit'): await voice_connect_limiter.acquire()
+                with metrics.timer('streambot_reconcile_step_seconds', step='voice_move'): await vc.move_to(voice_channel) # Move if in wrong channel
+            status.voice_client = vc
         else: # Not connected, so connect
-            vc = await voice_channel.connect()
-            status['voice_client'] = vc
+            with metrics.timer('streambot_reconcile_step_seconds', step='rate_limit'): await voice_connect_limiter.acquire()
+            with metrics.timer('streambot_reconcile_step_seconds', step='voice_connect'): vc = await voice_channel.connect()
+            status.voice_client = vc
 
         # At this point, vc should be valid and connected to target_channel_id
+        update_listeners(guild_id, voice_channel, immediate=True) # Don't start decoding into an empty channel
         # Start playback using the resolved stream_url_to_use
         bot.loop.create_task(play_stream_continuous(vc, stream_url_to_use, guild_id, notification_channel))
 
     except discord.Forbidden:
         msg = f"Error de permisos al unirse o moverse a **{voice_channel.name}**. Verifica los permisos del bot."
-        print(f"{msg} en guild {guild.name}")
-        if notification_channel:
-            try: await notification_channel.send(msg)
-            except discord.Forbidden: pass
-        status['playing'] = False
+        log.error("%s en guild %s", msg, guild.name, extra=guild_fields(guild_id))
+        notifier.notify(notification_channel, msg)
+        status.lifecycle = FAILED
     except discord.ClientException as e:
         msg = f"Error de cliente al conectar a **{voice_channel.name}**: {e}"
-        print(f"{msg} en guild {guild.name}")
-        if notification_channel:
-            try: await notification_channel.send(msg)
-            except discord.Forbidden: pass
-        status['playing'] = False
+        log.error("%s en guild %s", msg, guild.name, extra=guild_fields(guild_id))
+        notifier.notify(notification_channel, msg)
+        status.lifecycle = FAILED
     except Exception as e:
         msg = f"Error inesperado al conectar a **{voice_channel.name}**: {e}"
-        print(f"{msg} en guild {guild.name}")
-        if notification_channel:
-            try: await notification_channel.send(msg)
-            except discord.Forbidden: pass
-        status['playing'] = False
-    active_guilds_playback_status[guild_id] = status
+        log.error("%s en guild %s", msg, guild.name, extra=guild_fields(guild_id))
+        notifier.notify(notification_channel, msg)
+        status.lifecycle = FAILED
 
 
-@tasks.loop(seconds=45)
+class RateLimiter:
+    """Token bucket shared by every coroutine that calls acquire()."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock: # Waiters are served in order
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+voice_connect_limiter = RateLimiter(VOICE_CONNECTS_PER_SECOND)
+
+
+class Notification:
+    """A notice posted (or waiting to be posted) to a guild's text channel, and how often it repeated."""
+    __slots__ = ('channel', 'text', 'count', 'first_at', 'message', 'queued')
+
+    def __init__(self, channel, text, now):
+        self.channel = channel
+        self.text = text
+        self.count = 1
+        self.first_at = now
+        self.message = None # discord.Message once sent; repeats edit it
+        self.queued = False
+
+
+class NotificationQueue:
+    """Text-channel notices from the playback and reconnect paths, sent by a background worker.
+
+    notify() never blocks. Repeats of a notice (same key, default its text) to the same guild
+    within NOTIFY_DEDUPE_SECONDS of the first one edit that message with a repeat count, and
+    repeats arriving before the worker gets to them are coalesced into one send or edit.
+    Sends and edits take a token from a global bucket and from a per-channel one (Discord
+    allows 5 messages per 5 s in a channel).
+    """
+    CHANNEL_RATE = 1.0
+    CHANNEL_BURST = 5
+    MAX_LENGTH = 1900 # Leaves room for the repeat counter under Discord's 2000 characters
+
+    def __init__(self):
+        self.entries = {} # (guild id, key) -> Notification
+        self.queue = None
+        self.task = None
+        self.limiter = RateLimiter(NOTIFY_MESSAGES_PER_SECOND, burst=5)
+        self.channel_limiters = {}
+        self._last_prune = 0.0
+
+    def start(self):
+        if self.queue is None: self.queue = asyncio.Queue()
+        if self.task is None or self.task.done(): self.task = asyncio.create_task(self._worker())
+
+    def notify(self, channel, text, key=None):
+        if channel is None: return
+        now = time.monotonic()
+        guild = getattr(channel, 'guild', None)
+        entry_key = (guild.id if guild else channel.id, key or text)
+        entry = self.entries.get(entry_key)
+        if entry and now - entry.first_at < NOTIFY_DEDUPE_SECONDS:
+            entry.count += 1
+            entry.text = text
+            metrics.inc('streambot_notifications_total', result='coalesced')
+        else:
+            entry = self.entries[entry_key] = Notification(channel, text, now)
+        if not entry.queued:
+            entry.queued = True
+            if self.queue is None: self.queue = asyncio.Queue()
+            self.queue.put_nowait(entry)
+        if now - self._last_prune >= NOTIFY_DEDUPE_SECONDS: self._prune(now)
+
+    def _prune(self, now):
+        self._last_prune = now
+        for entry_key, entry in list(self.entries.items()):
+            if not entry.queued and now - entry.first_at >= NOTIFY_DEDUPE_SECONDS: del self.entries[entry_key]
+        channel_ids = {entry.channel.id for entry in self.entries.values()}
+        for channel_id in list(self.channel_limiters):
+            if channel_id not in channel_ids: del self.channel_limiters[channel_id]
+
+    async def _worker(self):
+        while True:
+            entry = await self.queue.get()
+            try: await self._deliver(entry)
+            except Exception: log.exception("Notificaciones: error enviando a %s", entry.channel.id)
+            finally: self.queue.task_done()
+
+    async def _deliver(self, entry):
+        channel_limiter = self.channel_limiters.get(entry.channel.id)
+        if channel_limiter is None: channel_limiter = self.channel_limiters[entry.channel.id] = RateLimiter(self.CHANNEL_RATE, self.CHANNEL_BURST)
+        await self.limiter.acquire()
+        await channel_limiter.acquire()
+        entry.queued = False # Repeats from here on queue another edit
+        content = entry.text[:self.MAX_LENGTH] + (f" (×{entry.count})" if entry.count > 1 else "")
+        try:
+            if entry.message is None:
+                entry.message = await entry.channel.send(content)
+                metrics.inc('streambot_notifications_total', result='sent')
+            else:
+                await entry.message.edit(content=content)
+                metrics.inc('streambot_notifications_total', result='edited')
+        except discord.NotFound: entry.message = None # Channel or message deleted; a later repeat posts a new message
+        except discord.Forbidden: log.warning("No permission to send message in %s", getattr(entry.channel, 'name', entry.channel.id))
+        except discord.HTTPException as e: log.warning("Notificaciones: Discord rechazó el mensaje (%s).", e.status)
+
+notifier = NotificationQueue()
+
+
+class GuildReconciler:
+    """Dirty-guild queue drained by a bounded pool of workers running reconcile_guild.
+
+    A guild is queued at most once; if it is marked dirty while a worker is reconciling it,
+    it is queued again when that worker finishes, so two workers never touch the same guild.
+    """
+
+    def __init__(self, workers):
+        self.worker_count = workers
+        self.queue = None
+        self.pending = set()
+        self.in_progress = set()
+        self.rerun = set()
+        self.workers = []
+
+    def start(self):
+        if self.workers: return
+        if self.queue is None: self.queue = asyncio.Queue()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    def mark_dirty(self, guild_id, delay=None):
+        if not owns_guild(guild_id): return # Another shard process manages it
+        if delay:
+            bot.loop.call_later(delay, self.mark_dirty, guild_id)
+            return
+        if self.queue is None: self.queue = asyncio.Queue()
+        if guild_id in self.in_progress: self.rerun.add(guild_id); return
+        if guild_id in self.pending: return
+        self.pending.add(guild_id)
+        self.queue.put_nowait(guild_id)
+
+    async def _worker(self):
+        while True:
+            guild_id = await self.queue.get()
+            self.pending.discard(guild_id)
+            self.in_progress.add(guild_id)
+            started = time.perf_counter()
+            try: await reconcile_guild(guild_id)
+            except Exception: log.exception("Reconciler: error reconciliando guild", extra=guild_fields(guild_id))
+            finally:
+                metrics.observe('streambot_reconcile_guild_seconds', time.perf_counter() - started)
+                self.in_progress.discard(guild_id)
+                self.queue.task_done()
+                if guild_id in self.rerun:
+                    self.rerun.discard(guild_id)
+                    self.mark_dirty(guild_id)
+
+reconciler = GuildReconciler(RECONCILE_WORKERS)
+config_store.on_guild_changed = reconciler.mark_dirty
+
+
+async def reconcile_guild(guild_id):
+    """Brings one guild's voice connection and playback in line with config and in-memory intent."""
+    guild_config_from_file = config_store.get_guild(guild_id) # Config from file for this guild
+    current_status_in_memory = guild_registry.get(guild_id)
+    guild = bot.get_guild(guild_id)
+
+    if not guild: # Bot is no longer in this guild
+        guild_registry.remove(guild_id)
+        return
+
+    notif_channel_id = current_status_in_memory and current_status_in_memory.text_channel_for_notif_id
+    notification_channel = bot.get_channel(notif_channel_id) if notif_channel_id else guild.system_channel
+
+    if current_status_in_memory and current_status_in_memory.wants_playback: # If bot is intended to be playing
+        if 'channel_id' not in guild_config_from_file:
+            # Was told to play, but configuration is gone. Stop it.
+            log.info("Reconciler: el guild quiere reproducir pero ya no está configurado. Deteniendo.", extra=guild_fields(guild_id))
+            vc = current_status_in_memory.voice_client
+            if vc and vc.is_connected():
+                if vc.is_playing(): vc.stop()
+                with metrics.timer('streambot_reconcile_step_seconds', step='disconnect'): await vc.disconnect()
+            guild_registry.remove(guild_id)
+            return
+
+        target_channel_id = guild_config_from_file['channel_id']
+        vc = guild.voice_client
+        if vc and vc.is_connected() and vc.channel.id == target_channel_id:
+            with metrics.timer('streambot_reconcile_step_seconds', step='listeners'): update_listeners(guild_id, vc.channel) # Catch up on missed voice events
+
+        if not vc or not vc.is_connected() or vc.channel.id != target_channel_id:
+            log.info("Reconciler: Bot no en canal correcto para %s (Objetivo: %s). (Re)conectando.", guild.name, target_channel_id, extra=guild_fields(guild_id))
+            with metrics.timer('streambot_reconcile_step_seconds', step='connect'): await ensure_voice_connection_and_play(guild_id, target_channel_id, notification_channel)
+        elif vc.is_playing():
+            if current_status_in_memory.lifecycle in (CONNECTING, WAITING): current_status_in_memory.lifecycle = PLAYING # Restarted by an earlier pass
+        elif current_status_in_memory.lifecycle != SUSPENDED:
+            # In correct channel, but not playing. Resolve URL and start.
+            resolved_stream_url = current_status_in_memory.stream_url or guild_config_from_file.get('stream_url', RADIO_STREAM_URL)
+            log.info("Reconciler: Bot en %s pero no reproduciendo. Reiniciando stream.", vc.channel.name, extra=guild_fields(guild_id, resolved_stream_url))
+            bot.loop.create_task(play_stream_continuous(vc, resolved_stream_url, guild_id, notification_channel))
+
+    elif 'channel_id' in guild_config_from_file and guild_config_from_file.get('auto_join_on_startup', True):
+        # Configured for auto-join, but not currently marked as playing (e.g., after restart, or a failed attempt)
+        log.info("Reconciler: guild configurado para auto-join y no reproduciendo. Iniciando.", extra=guild_fields(guild_id))
+        with metrics.timer('streambot_reconcile_step_seconds', step='connect'): await ensure_voice_connection_and_play(guild_id, guild_config_from_file['channel_id'], notification_channel)
+
+    elif current_status_in_memory and current_status_in_memory.lifecycle == FAILED:
+        current_status_in_memory.lifecycle = STOPPED # A manual !join that failed is not retried
+
+
+@tasks.loop(seconds=FULL_SWEEP_INTERVAL)
 async def maintain_voice_connections_task():
+    # Safety net only: normal recovery is event-driven through reconciler.mark_dirty.
     await bot.wait_until_ready()
-    config = load_config()
-    # Consider all guilds from config and any currently active guilds
-    guild_ids_to_check = set(map(int, config.keys())) | set(g_id for g_id, stat in active_guilds_playback_status.items() if stat.get('playing'))
+    if warm_start.running: return # The warm start is already queuing every auto-join guild at a controlled rate
+    started = time.perf_counter()
+    # Guilds that are waiting on a (re)connect or failed one, waiting guilds no breaker is holding back, plus
+    # playing/suspended guilds whose voice client dropped without an event. Newly configured guilds arrive
+    # through the commands, on_ready and on_guild_changed.
+    with metrics.timer('streambot_reconcile_step_seconds', step='sweep_scan'):
+        guild_ids_to_check = guild_registry.needing_attention
+        held = {guild_id for breaker in stream_hub.breakers.values() if not breaker.can_retry() for guild_id in breaker.waiting}
+        guild_ids_to_check.update(state.guild_id for state in guild_registry.in_state(WAITING) if state.guild_id not in held)
+        for state in guild_registry.in_state(PLAYING) + guild_registry.in_state(SUSPENDED):
+            vc = state.voice_client
+            if not vc or not vc.is_connected() or (state.lifecycle == PLAYING and not vc.is_playing()): guild_ids_to_check.add(state.guild_id)
+        for guild_id in guild_ids_to_check: reconciler.mark_dirty(guild_id) # Skips guilds owned by other shards
+    with metrics.timer('streambot_reconcile_step_seconds', step='sweep_drain'):
+        await reconciler.queue.join() # The sweep is done when every queued guild has been reconciled
+    metrics.observe('streambot_reconcile_sweep_seconds', time.perf_counter() - started)
+
 
-    for guild_id in guild_ids_to_check:
-        guild_config_from_file = config.get(str(guild_id)) # Config from file for this guild
-        current_status_in_memory = active_guilds_playback_status.get(guild_id, {})
+class WarmStartScheduler:
+    """Queues auto-join guilds on the reconciler at STARTUP_GUILDS_PER_SECOND, most important first.
+
+    Priority: guilds with listeners already in the target channel, then by most recent
+    'last_active_at'. schedule() can be called again (e.g. on a repeated on_ready) while a
+    ramp is running; guilds already waiting are not queued twice.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.scheduled = set()
+        self.task = None
+
+    @property
+    def running(self): return self.task is not None and not self.task.done()
+
+    def priority(self, guild_id):
         guild = bot.get_guild(guild_id)
+        channel = guild.get_channel(config_store.get_guild(guild_id).get('channel_id')) if guild else None
+        has_listeners = bool(channel and isinstance(channel, discord.VoiceChannel) and count_listeners(channel))
+        return (0 if has_listeners else 1, -config_store.get_guild(guild_id).get('last_active_at', 0))
 
-        if not guild: # Bot is no longer in this guild
-            if guild_id in active_guilds_playback_status: del active_guilds_playback_status[guild_id]
-            continue
-
-        notif_channel_id = current_status_in_memory.get('text_channel_for_notif_id')
-        notification_channel = bot.get_channel(notif_channel_id) if notif_channel_id else guild.system_channel
-
-        if current_status_in_memory.get('playing'): # If bot is intended to be playing
-            if not guild_config_from_file or 'channel_id' not in guild_config_from_file:
-                # Was told to play, but configuration is gone. Stop it.
-                print(f"Maintain task: Guild {guild_id} quiere reproducir pero ya no está configurado. Deteniendo.")
-                if guild_id in active_guilds_playback_status:
-                    vc = current_status_in_memory.get('voice_client')
-                    if vc and vc.is_connected():
-                        if vc.is_playing(): vc.stop()
-                        await vc.disconnect()
-                    del active_guilds_playback_status[guild_id]
-                continue
+    def schedule(self, guild_ids):
+        for guild_id in guild_ids:
+            if guild_id in self.scheduled: continue
+            self.scheduled.add(guild_id)
+            heapq.heappush(self.heap, (self.priority(guild_id), guild_id))
+        if self.heap and not self.running: self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        limiter = RateLimiter(STARTUP_GUILDS_PER_SECOND)
+        started, total = time.perf_counter(), len(self.heap)
+        while self.heap:
+            _, guild_id = heapq.heappop(self.heap)
+            self.scheduled.discard(guild_id)
+            await limiter.acquire()
+            reconciler.mark_dirty(guild_id)
+        log.info("Warm start: %d servidor(es) encolados en %.1f s.", total, time.perf_counter() - started)
+
+warm_start = WarmStartScheduler()
+
+
+def collect_runtime_metrics():
+    for state in guild_registry:
+        yield 'streambot_guild_info', {'guild_id': state.guild_id, 'state': state.lifecycle, 'url': state.url or ''}, 1
+    for lifecycle, count in guild_registry.counts().items():
+        yield 'streambot_guilds', {'state': lifecycle}, count
+    for url, guild_ids in list(guild_registry.by_url.items()):
+        yield 'streambot_stream_guilds', {'url': url}, len(guild_ids)
+    decoders = list(stream_hub.decoders.values())
+    running = decoder_supervisor.running()
+    yield 'streambot_ffmpeg_processes', {}, len(running)
+    yield 'streambot_standby_decoders', {}, len(stream_hub.standbys)
+    usage = defaultdict(lambda: [0, 0.0])
+    for record in running:
+        role = 'standby' if stream_hub.standbys.get(record.decoder.url) is record.decoder else 'primary'
+        usage[record.decoder.url, role][0] += record.rss
+        usage[record.decoder.url, role][1] += record.cpu_percent
+    # One loop per family: the text format requires all samples of a metric on consecutive lines.
+    for (url, role), (rss, _) in usage.items(): yield 'streambot_ffmpeg_rss_bytes', {'url': url, 'role': role}, rss
+    for (url, role), (_, cpu_percent) in usage.items(): yield 'streambot_ffmpeg_cpu_percent', {'url': url, 'role': role}, round(cpu_percent, 2)
+    for d in decoders: yield 'streambot_decoder_subscribers', {'url': d.url}, d.subscribers
+    for d in decoders: yield 'streambot_decoder_underruns_total', {'url': d.url}, d.underruns
+    for d in decoders: yield 'streambot_decoder_overruns_total', {'url': d.url}, d.overruns
+    for d in decoders: yield 'streambot_decoder_gain_levels', {'url': d.url}, len(d.gain.levels)
+    for url, breaker in list(stream_hub.breakers.items()):
+        yield 'streambot_stream_circuit_open', {'url': url}, int(breaker.state != 'closed')
+    yield 'streambot_reconcile_queue_depth', {}, len(reconciler.pending)
+    yield 'streambot_event_loop_lag_last_seconds', {}, loop_lag_monitor.last_lag
+
+metrics.collectors.append(collect_runtime_metrics)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a fixed sleep.
+
+    A watchdog thread watches the heartbeat the loop task leaves on every wake-up. When it is
+    more than LOOP_STALL_SECONDS late, the loop is blocked right now, so the loop thread's
+    current stack (from sys._current_frames) shows the code that is holding it.
+    """
+    INTERVAL = 0.5
+    WATCH_INTERVAL = 0.05
+    STACK_LIMIT = 15 # Innermost frames kept per stall
+    MAX_STALLS = 20
+
+    def __init__(self):
+        self.last_lag = 0.0
+        self.task = None
+        self.thread = None
+        self.loop_thread_id = None
+        self.heartbeat = None # time.monotonic() of the loop's last wake-up
+        self.stalls = deque(maxlen=self.MAX_STALLS) # [wall time, seconds blocked, stack], newest last
+
+    def start(self):
+        if self.task is None or self.task.done(): self.task = asyncio.create_task(self._run())
+        if LOOP_STALL_SECONDS > 0 and self.thread is None:
+            self.loop_thread_id = threading.get_ident()
+            self.thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+            self.thread.start()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.INTERVAL
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.INTERVAL)
+            self.last_lag = max(0.0, loop.time() - expected)
+            metrics.observe('streambot_event_loop_lag_seconds', self.last_lag)
+            if self.stalls and self.stalls[-1][1] is None: self.stalls[-1][1] = self.last_lag # Close the stall the watchdog caught
+
+    def _watch(self):
+        caught = None # Heartbeat of the stall already sampled, so a long stall is reported once
+        while True:
+            time.sleep(self.WATCH_INTERVAL)
+            beat = self.heartbeat
+            if beat is None or beat == caught or time.monotonic() - beat - self.INTERVAL < LOOP_STALL_SECONDS: continue
+            caught = beat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame, limit=self.STACK_LIMIT)) if frame else ''
+            del frame
+            self.stalls.append([time.time(), None, stack])
+            metrics.inc('streambot_event_loop_stalls_total')
+            log.warning("Event loop bloqueado más de %.0f ms. Pila del hilo del loop:\n%s", LOOP_STALL_SECONDS * 1000, stack.rstrip())
+
+    def report(self):
+        lines = []
+        for at, blocked, stack in list(self.stalls):
+            duration = f"{blocked * 1000:.0f} ms" if blocked is not None else "en curso"
+            lines.append(f"# {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(at))} retraso {duration}\n{stack}")
+        return '\n'.join(lines)
+
+loop_lag_monitor = LoopLagMonitor()
+
+
+class SamplingProfiler:
+    """Opt-in statistical profiler: samples every thread's stack each PROFILE_SAMPLE_INTERVAL.
+
+    Off until start() (from !profile or SIGUSR1), so it costs nothing in normal operation.
+    Stacks are aggregated in folded form ("thread;outer;...;inner count"), which flamegraph.pl
+    and speedscope read directly.
+    """
+    MAX_DEPTH = 64
+    MAX_STACKS = 2000 # Distinct stacks written to a dump, most sampled first
+    IGNORED_THREADS = ('profiler', 'loop-watchdog', 'log-listener') # Our own instrumentation, idle nearly all the time
+
+    def __init__(self):
+        self.stacks = defaultdict(int) # folded stack -> samples
+        self.samples = 0
+        self.started_at = None
+        self.thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self): return self.thread is not None
+
+    def start(self):
+        if self.running: return
+        self.stacks.clear(); self.samples = 0
+        self.started_at = time.monotonic()
+        self._stop.clear()
+        self.thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.running: return
+        self._stop.set()
+        self.thread.join()
+        self.thread = None
+
+    def _sample(self):
+        while not self._stop.wait(PROFILE_SAMPLE_INTERVAL):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if names.get(ident) in self.IGNORED_THREADS: continue
+                calls = []
+                while frame is not None and len(calls) < self.MAX_DEPTH:
+                    code = frame.f_code
+                    calls.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                calls.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(calls))] += 1
+            self.samples += 1
+            del frame
+
+    def top_functions(self, count=10):
+        """(function, share of samples in which it was the innermost frame), busiest first."""
+        leaves = defaultdict(int)
+        for stack, n in list(self.stacks.items()): leaves[stack.rsplit(';', 1)[-1]] += n
+        total = sum(leaves.values()) or 1
+        return [(function, n / total) for function, n in sorted(leaves.items(), key=lambda item: -item[1])[:count]]
+
+    def dump(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        stacks = sorted(list(self.stacks.items()), key=lambda item: -item[1])[:self.MAX_STACKS]
+        lines = [f"# StreamBot: {self.samples} muestras cada {PROFILE_SAMPLE_INTERVAL * 1000:.0f} ms en {elapsed:.1f} s (pid {os.getpid()})",
+                 "# Funciones más muestreadas (frame más interno):"]
+        lines += [f"#   {share:6.1%}  {function}" for function, share in self.top_functions(20)]
+        lines += ["# Pilas en formato folded (flamegraph.pl, speedscope):"]
+        lines += [f"{stack} {n}" for stack, n in stacks]
+        stalls = loop_lag_monitor.report()
+        if stalls: lines += ["", "# Bloqueos recientes del event loop:", stalls]
+        return '\n'.join(lines) + '\n'
+
+profiler = SamplingProfiler()
+
+def write_profile_dump():
+    """Stops the profiler and writes its dump to PROFILE_DIR. Blocking: run it off the event loop."""
+    profiler.stop()
+    path = os.path.join(PROFILE_DIR, f"streambot-profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+    with open(path, 'w') as f: f.write(profiler.dump())
+    return path
+
+async def toggle_profiler():
+    """SIGUSR1: the first signal starts the profiler, the next one writes the dump and stops it."""
+    if not profiler.running:
+        profiler.start()
+        log.info("Perfilador iniciado. Envía SIGUSR1 de nuevo para guardar el perfil.")
+        return
+    try: path = await asyncio.to_thread(write_profile_dump)
+    except OSError as e: log.error("No se pudo guardar el perfil en %s: %s", PROFILE_DIR, e)
+    else: log.info("Perfil guardado en %s", path)
+
+def install_profiler_signal():
+    if not hasattr(signal, 'SIGUSR1'): return # Windows: use !profile instead
+    try: bot.loop.add_signal_handler(signal.SIGUSR1, lambda: bot.loop.create_task(toggle_profiler()))
+    except (NotImplementedError, RuntimeError): pass # Loop without signal support, or not in the main thread
+
+
+async def handle_metrics_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)).strip(): pass # Skip headers
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            body, status_line = metrics.render().encode(), '200 OK'
+        else:
+            body, status_line = b'Not Found\n', '404 Not Found'
+        writer.write(f'HTTP/1.1 {status_line}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError): pass
+    finally: writer.close()
+
+metrics_server = None
+
+
+def shard_summary():
+    """Compact health/stats snapshot of this process, sent to the coordinator with every heartbeat."""
+    return {
+        'shard_ids': SHARD_IDS, 'pid': os.getpid(), 'ready': bot.is_ready(), 'guilds': len(bot.guilds), 'states': guild_registry.counts(),
+        'latency_ms': round(bot.latency * 1000) if bot.latency == bot.latency else None, # NaN before the first heartbeat ack
+        'ffmpeg': len(decoder_supervisor.running()),
+        'loop_lag_ms': round(loop_lag_monitor.last_lag * 1000, 1),
+        'restarts': metrics.total('streambot_guild_restarts_total'),
+    }
+
+
+class CoordinatorClient:
+    """Talks to launcher.py's coordinator over COORDINATOR_SOCKET (newline-delimited JSON).
 
-            target_channel_id = guild_config_from_file['channel_id']
-            vc = guild.voice_client
+    Started from setup_hook, before login: identifying many shards can take minutes, and the
+    coordinator must keep hearing from the process meanwhile ('ready': False in the heartbeat).
+    Sends a heartbeat with shard_summary() every HEARTBEAT_INTERVAL seconds and answers
+    cluster-wide questions for !ping/!stats from the coordinator's cache of every shard's last heartbeat.
+    """
+    HEARTBEAT_INTERVAL = 10
 
-            if not vc or not vc.is_connected() or vc.channel.id != target_channel_id:
-                print(f"Maintain task: Bot no en canal correcto para {guild.name} (Objetivo: {target_channel_id}). (Re)conectando.")
-                await ensure_voice_connection_and_play(guild_id, target_channel_id, notification_channel)
-            elif vc.is_connected() and not vc.is_playing():
-                # In correct channel, but not playing. Resolve URL and start.
-                resolved_stream_url = current_status_in_memory.get('stream_url') or guild_config_from_file.get('stream_url', RADIO_STREAM_URL)
-                print(f"Maintain task: Bot en {vc.channel.name} pero no reproduciendo. Reiniciando stream con {resolved_stream_url}.")
-                bot.loop.create_task(play_stream_continuous(vc, resolved_stream_url, guild_id, notification_channel))
+    def __init__(self, path):
+        self.path = path
+        self.task = None
+        self.writer = None
+        self.replies = {} # Request id -> Future
+        self.next_id = 0
 
-        elif guild_config_from_file and 'channel_id' in guild_config_from_file and guild_config_from_file.get('auto_join_on_startup', True):
-            # Configured for auto-join, but not currently marked as 'playing' (e.g., after restart and initial on_ready population)
-            if not current_status_in_memory.get('playing'): # Ensure it's not already processing
-                print(f"Maintain task: Guild {guild_id} configurado para auto-join y no reproduciendo. Iniciando.")
-                target_channel_id = guild_config_from_file['channel_id']
-                await ensure_voice_connection_and_play(guild_id, target_channel_id, notification_channel)
+    def start(self):
+        if self.path and (self.task is None or self.task.done()): self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+                await self._send({'op': 'hello', 'shard_ids': SHARD_IDS, 'pid': os.getpid()})
+                heartbeat = asyncio.create_task(self._heartbeat())
+                try:
+                    while line := await reader.readline():
+                        message = json.loads(line)
+                        future = self.replies.pop(message.get('id'), None)
+                        if future and not future.done(): future.set_result(message)
+                finally: heartbeat.cancel()
+            except (OSError, ValueError) as e: log.warning("Coordinador no disponible (%s). Reintentando...", e)
+            self.writer = None
+            await asyncio.sleep(5)
+
+    async def _heartbeat(self):
+        while True:
+            await self._send({'op': 'heartbeat', 'stats': shard_summary()})
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+
+    async def _send(self, message):
+        self.writer.write(json.dumps(message).encode() + b'\n')
+        await self.writer.drain()
+
+    async def cluster_stats(self, timeout=3):
+        """Latest summary of every shard process, or None when not running under the coordinator."""
+        if not self.writer: return None
+        self.next_id += 1
+        request_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.replies[request_id] = future
+        try:
+            await self._send({'op': 'cluster_stats', 'id': request_id})
+            return (await asyncio.wait_for(future, timeout))['shards']
+        except (asyncio.TimeoutError, OSError, KeyError): return None
+        finally: self.replies.pop(request_id, None)
+
+coordinator_client = CoordinatorClient(COORDINATOR_SOCKET)
+
+async def start_metrics_server():
+    global metrics_server
+    if METRICS_PORT <= 0 or metrics_server is not None: return
+    metrics_server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+    log.info("Métricas Prometheus en http://%s:%d/metrics", METRICS_HOST, METRICS_PORT)
 
 
+@bot.event
+async def setup_hook():
+    coordinator_client.start() # Heartbeats must flow while the shards are still identifying
+
 @bot.event
 async def on_ready():
-    print(f'{bot.user.name} has connected to Discord!')
-    if shutil.which("ffmpeg"): print("FFmpeg encontrado.")
-    else: print("ADVERTENCIA: FFmpeg no parece estar instalado o en el PATH. La reproducción de audio fallará.")
+    log.info("%s has connected to Discord!", bot.user.name)
+    if shutil.which("ffmpeg"): log.info("FFmpeg encontrado.")
+    else: log.warning("FFmpeg no parece estar instalado o en el PATH. La reproducción de audio fallará.")
 
-    print(f'Conectado a {len(bot.guilds)} servidor(es).')
-    for guild in bot.guilds: print(f'- {guild.name} (ID: {guild.id})')
+    log.info("Conectado a %d servidor(es).", len(bot.guilds))
+    if len(bot.guilds) <= 20: # Listing thousands of guilds on every (re)connect only slows startup down
+        for guild in bot.guilds: log.info("- %s (ID: %s)", guild.name, guild.id)
 
     if not os.path.exists(CONFIG_FILE): save_config({})
-    else: print(f"{CONFIG_FILE} cargado.")
+    else: log.info("%s cargado.", CONFIG_FILE)
 
-    config = load_config()
+    config = config_store.get()
+    auto_join_guild_ids = []
     for guild_id_str, conf_data_from_file in config.items():
         guild_id = int(guild_id_str)
+        if not owns_guild(guild_id): continue
         if 'channel_id' in conf_data_from_file and conf_data_from_file.get('auto_join_on_startup', True):
-            # Pre-populate status for maintain_task.
-            # stream_url here is pre-resolved to assist maintain_task if it calls play_stream_continuous directly.
-            active_guilds_playback_status[guild_id] = {
-                'target_channel_id': conf_data_from_file['channel_id'],
-                'playing': True, # Set intent to play
-                'voice_client': None, # To be populated by ensure_voice_connection_and_play
-                'text_channel_for_notif_id': None, # No specific command context on startup
-                'stream_url': conf_data_from_file.get('stream_url', RADIO_STREAM_URL)
-            }
-            print(f"Guild {guild_id} marcado para auto-join y play en startup.")
+            auto_join_guild_ids.append(guild_id)
+            if guild_id in guild_registry: continue # Repeated on_ready: keep the live state
+            # Pre-populate state for the reconciler; voice_client is set by ensure_voice_connection_and_play.
+            state = guild_registry.setdefault(guild_id)
+            state.target_channel_id = conf_data_from_file['channel_id']
+            state.stream_url = conf_data_from_file.get('stream_url', RADIO_STREAM_URL)
+            state.lifecycle = CONNECTING # Set intent to play
+    log.info("%d servidor(es) marcados para auto-join.", len(auto_join_guild_ids))
 
+    reconciler.start()
+    notifier.start()
+    decoder_supervisor.start()
+    loop_lag_monitor.start()
+    install_profiler_signal()
+    try: await start_metrics_server()
+    except OSError as e: log.error("No se pudo iniciar el servidor de métricas en el puerto %d: %s", METRICS_PORT, e)
+    # Ramp connections instead of reconnecting everything at once; guilds already playing are no-ops for the reconciler.
+    warm_start.schedule(g for g in auto_join_guild_ids if guild_registry.get(g).lifecycle not in (PLAYING, SUSPENDED))
     if not maintain_voice_connections_task.is_running():
-        maintain_voice_connections_task.start()
-    print("on_ready setup completo. Tarea de mantenimiento iniciada.")
+        maintain_voice_connections_task.start() # Safety-net sweep; skipped while the warm start is running
+    log.info("on_ready setup completo. Tarea de mantenimiento iniciada.")
+
+def mark_configured_guild_dirty(guild):
+    """Queues an auto-join guild that (re)appeared, e.g. re-invited after a kick or back from an outage."""
+    guild_config = config_store.get_guild(guild.id)
+    if 'channel_id' in guild_config and guild_config.get('auto_join_on_startup', True):
+        reconciler.mark_dirty(guild.id) # Skips guilds owned by other shards
+
+@bot.event
+async def on_guild_join(guild): mark_configured_guild_dirty(guild)
+
+@bot.event
+async def on_guild_available(guild):
+    if bot.is_ready(): mark_configured_guild_dirty(guild) # At startup the warm start ramps these in instead
 
 @bot.event
 async def on_voice_state_update(member, before, after):
-    if member.id != bot.user.id: return # Only care about the bot's state changes
     guild_id = member.guild.id
-    status = active_guilds_playback_status.get(guild_id)
+    if member.id != bot.user.id: # A listener joined, left or moved: only matters for the guild's target channel
+        if before.channel != after.channel:
+            for channel in (before.channel, after.channel):
+                status = channel and guild_registry.for_channel(channel.id)
+                if status: update_listeners(status.guild_id, channel)
+        return
+    status = guild_registry.get(guild_id)
 
-    if not status or not status.get('playing'): return # Not supposed to be playing, so ignore
+    if not status or not status.wants_playback: return # Not supposed to be playing, so ignore
 
     if before.channel and not after.channel: # Bot was disconnected (kicked, or channel deleted)
-        print(f"Bot desconectado de {before.channel.name} en {member.guild.name}.")
-        target_channel_id = status.get('target_channel_id')
-        notif_channel_id = status.get('text_channel_for_notif_id')
-        notif_channel = bot.get_channel(notif_channel_id) if notif_channel_id else member.guild.system_channel
+        log.warning("Bot desconectado de %s en %s.", before.channel.name, member.guild.name, extra=guild_fields(guild_id))
+        if status.target_channel_id: # If a target channel is known
+            log.info("Re-unión a %s en %s encolada debido a desconexión.", status.target_channel_id, member.guild.name, extra=guild_fields(guild_id))
+            status.lifecycle = CONNECTING
+            reconciler.mark_dirty(guild_id, delay=5) # Brief delay; the reconciler resolves the correct stream URL
+    elif after.channel and after.channel.id != status.target_channel_id: # Bot was moved elsewhere
+        status.lifecycle = CONNECTING
+        reconciler.mark_dirty(guild_id)
 
-        if target_channel_id: # If a target channel is known
-            print(f"Intentando re-unirse inmediatamente a {target_channel_id} en {member.guild.name} debido a desconexión.")
-            await asyncio.sleep(5) # Brief delay
-            # ensure_voice_connection_and_play will resolve the correct stream URL
-            await ensure_voice_connection_and_play(guild_id, target_channel_id, notif_channel)
 
+@bot.before_invoke
+async def start_command_timer(ctx): ctx.command_started_at = time.perf_counter() # Runs after the command's checks passed
+
+@bot.after_invoke
+async def observe_command_time(ctx):
+    metrics.observe('streambot_command_seconds', time.perf_counter() - ctx.command_started_at, command=ctx.command.qualified_name)
 
 @bot.command(name='ping')
-async def ping(ctx): await ctx.send(f'Pong! Latencia: {round(bot.latency * 1000)}ms')
+async def ping(ctx):
+    shards = await coordinator_client.cluster_stats()
+    if not shards: await ctx.send(f'Pong! Latencia: {round(bot.latency * 1000)}ms'); return
+    lines = [f"Shards {','.join(map(str, s['shard_ids']))}: {s['latency_ms']}ms" + (" (sin heartbeat)" if s.get('stale') else "" if s.get('ready', True) else " (iniciando)") for s in shards]
+    await ctx.send(f'Pong! Latencia: {round(bot.latency * 1000)}ms\n' + '\n'.join(lines))
 
 @bot.command(name='configurechannel')
 @commands.has_permissions(administrator=True)
@@ -304,23 +2230,13 @@ async def configurechannel(ctx, *, channel_name: str):
     if not guild: await ctx.send("Solo en servidor."); return
     voice_channel = discord.utils.get(guild.voice_channels, name=channel_name)
     if voice_channel:
-        config = load_config()
-        guild_config = config.get(str(guild.id), {})
-        guild_config['channel_id'] = voice_channel.id
-        guild_config['channel_name'] = voice_channel.name
-        guild_config['auto_join_on_startup'] = True
-        config[str(guild.id)] = guild_config
-        save_config(config)
+        config_store.update_guild(guild.id, channel_id=voice_channel.id, channel_name=voice_channel.name, auto_join_on_startup=True)
         await ctx.send(f"Canal configurado: **{voice_channel.name}**. Intentando unirse y reproducir.")
 
-        current_status = active_guilds_playback_status.get(guild.id, {})
-        current_status.update({
-            'target_channel_id': voice_channel.id,
-            'playing': True,
-            'text_channel_for_notif_id': ctx.channel.id
-            # stream_url will be resolved by ensure_voice_connection_and_play
-        })
-        active_guilds_playback_status[guild.id] = current_status
+        current_status = guild_registry.setdefault(guild.id)
+        current_status.target_channel_id = voice_channel.id
+        current_status.text_channel_for_notif_id = ctx.channel.id
+        current_status.lifecycle = CONNECTING # stream_url will be resolved by ensure_voice_connection_and_play
         await ensure_voice_connection_and_play(guild.id, voice_channel.id, ctx.channel) # No URL directly passed
     else:
         await ctx.send(f"Canal de voz '{channel_name}' no encontrado.")
@@ -329,54 +2245,50 @@ async def configurechannel(ctx, *, channel_name: str):
 async def cex_error(ctx, error): # Renamed to avoid conflict
     if isinstance(error, commands.MissingPermissions): await ctx.send("Necesitas permisos de Administrador.")
     elif isinstance(error, commands.MissingRequiredArgument): await ctx.send("Uso: `!configurechannel <nombre_canal>`")
-    else: await ctx.send(f"Error en configurechannel: {error}"); print(f"Error en configurechannel: {error}")
+    else: await ctx.send(f"Error en configurechannel: {error}"); log.error("Error en configurechannel: %s", error)
 
 @bot.command(name='join')
 async def join(ctx):
     guild = ctx.guild
     if not guild: await ctx.send("Solo en servidor."); return
-    config_data = load_config() # Renamed to avoid conflict with global 'config' name
-    guild_conf = config_data.get(str(guild.id))
+    guild_conf = config_store.get_guild(guild.id)
     if not guild_conf or 'channel_id' not in guild_conf:
         await ctx.send("Canal no configurado. Usa `!configurechannel`."); return
     target_channel_id = guild_conf['channel_id']
 
-    if guild.id not in active_guilds_playback_status: active_guilds_playback_status[guild.id] = {}
-    active_guilds_playback_status[guild.id].update({
-        'target_channel_id': target_channel_id,
-        'playing': True,
-        'text_channel_for_notif_id': ctx.channel.id
-        # stream_url will be resolved by ensure_voice_connection_and_play
-    })
+    current_status = guild_registry.setdefault(guild.id)
+    current_status.target_channel_id = target_channel_id
+    current_status.text_channel_for_notif_id = ctx.channel.id
+    current_status.lifecycle = CONNECTING # stream_url will be resolved by ensure_voice_connection_and_play
     await ctx.send(f"Intentando unirme y reproducir en el canal configurado...")
     await ensure_voice_connection_and_play(guild.id, target_channel_id, ctx.channel) # No URL directly passed
 
 @join.error
 async def join_error(ctx, error):
-    await ctx.send(f"Error en `!join`: {error}. Revisa consola."); print(f"Error en join: {error}")
+    await ctx.send(f"Error en `!join`: {error}. Revisa consola."); log.error("Error en join: %s", error)
 
 @bot.command(name='leave')
 async def leave(ctx):
     guild = ctx.guild
     if not guild: await ctx.send("Solo en servidor."); return
-    if guild.id in active_guilds_playback_status:
-        active_guilds_playback_status[guild.id]['playing'] = False
-        # Also clear current_stream_url if it exists
-        active_guilds_playback_status[guild.id].pop('current_stream_url', None)
+    current_status = guild_registry.get(guild.id)
+    if current_status:
+        current_status.lifecycle = STOPPED
+        if current_status.idle_timer: current_status.idle_timer.cancel(); current_status.idle_timer = None
+        current_status.current_stream_url = None
     vc = guild.voice_client
     if vc and vc.is_connected():
         cn = vc.channel.name
         if vc.is_playing(): vc.stop()
         await vc.disconnect()
         await ctx.send(f"Desconectado de **{cn}**.")
-        if guild.id in active_guilds_playback_status:
-             active_guilds_playback_status[guild.id]['voice_client'] = None
+        if current_status: current_status.voice_client = None
     else:
         await ctx.send("No estoy en un canal de voz.")
 
 @leave.error
 async def leave_error(ctx, error):
-    await ctx.send(f"Error en `!leave`: {error}. Revisa consola."); print(f"Error en leave: {error}")
+    await ctx.send(f"Error en `!leave`: {error}. Revisa consola."); log.error("Error en leave: %s", error)
 
 @bot.command(name='setstreamurl')
 @commands.has_permissions(administrator=True)
@@ -386,43 +2298,127 @@ async def setstreamurl(ctx, *, url: str):
     if not (url.startswith('http://') or url.startswith('https://')):
         await ctx.send("La URL del stream no es válida."); return
 
-    config_data = load_config() # Renamed
-    guild_config = config_data.get(str(guild.id), {})
-    guild_config['stream_url'] = url # Save new URL to be read by ensure_voice_connection_and_play
-    config_data[str(guild.id)] = guild_config
-    save_config(config_data)
+    guild_config = config_store.update_guild(guild.id, stream_url=url) # Save new URL to be read by ensure_voice_connection_and_play
     await ctx.send(f"URL del stream actualizada para este servidor a: <{url}>")
-    print(f"Server '{guild.name}' updated stream URL to: {url}")
+    log.info("Server '%s' updated stream URL", guild.name, extra=guild_fields(guild.id, url))
 
-    current_status = active_guilds_playback_status.get(guild.id, {})
-    current_status['stream_url'] = url # Update in-memory status immediately
+    current_status = guild_registry.setdefault(guild.id)
+    current_status.stream_url = url # Update in-memory status immediately
 
-    if current_status.get('playing'): # If it was already supposed to be playing
-        active_guilds_playback_status[guild.id] = current_status # Save back updated status
+    if current_status.wants_playback: # If it was already supposed to be playing
+        play_url = await stream_resolver.resolve(url) # Playlists and redirects are expanded once, before prebuffering
         vc = guild.voice_client
+        if vc and vc.is_connected() and vc.is_playing() and isinstance(vc.source, SharedStreamSource):
+            # Gapless: the old stream keeps playing until the new one is prebuffered, then the source switches over.
+            try:
+                stream_hub.swap(vc.source, play_url, guild.id)
+                current_status.text_channel_for_notif_id = ctx.channel.id # finish_swap reports a failed switch here
+                await ctx.send("Cambiando a la nueva URL sin cortar la reproducción...")
+                return
+            except discord.ClientException as e: # Includes StreamBackoff; fall back to a full restart
+                log.info("Hot-swap no disponible en %s: %s", guild.name, e, extra=guild_fields(guild.id))
         if vc and vc.is_connected():
             await ctx.send("Reiniciando la reproducción con la nueva URL...")
-            if vc.is_playing() or vc.is_paused(): vc.stop(); await asyncio.sleep(0.5)
+            if vc.is_playing() or vc.is_paused(): stop_for_restart(vc); await asyncio.sleep(0.5)
 
-            target_channel_id = current_status.get('target_channel_id') or guild_config.get('channel_id')
+            target_channel_id = current_status.target_channel_id or guild_config.get('channel_id')
             if target_channel_id:
-                # ensure_voice_connection_and_play will now pick up the new URL from config or the updated active_guilds_playback_status
+                # ensure_voice_connection_and_play will now pick up the new URL from config
                 await ensure_voice_connection_and_play(guild.id, target_channel_id, ctx.channel)
             else:
                 await ctx.send("No hay canal configurado. Usa `!configurechannel`.")
         else: # Not connected but was 'playing'
-            active_guilds_playback_status[guild.id] = current_status
             await ctx.send("URL guardada. Se usará al (re)conectar.")
     else: # Not playing, just save the URL and update status
-        current_status['playing'] = False
-        active_guilds_playback_status[guild.id] = current_status
         await ctx.send("URL del stream guardada.")
 
 @setstreamurl.error
 async def setstreamurl_error(ctx, error):
     if isinstance(error, commands.MissingPermissions): await ctx.send("No tienes permisos de Administrador.")
     elif isinstance(error, commands.MissingRequiredArgument): await ctx.send("Uso: `!setstreamurl <URL>`")
-    else: await ctx.send(f"Error en `setstreamurl`: {error}"); print(f"Error en setstreamurl: {error}")
+    else: await ctx.send(f"Error en `setstreamurl`: {error}"); log.error("Error en setstreamurl: %s", error)
+
+@bot.command(name='volume')
+@commands.has_permissions(administrator=True)
+async def volume(ctx, setting: str = None):
+    guild = ctx.guild
+    if not guild: await ctx.send("Este comando solo puede usarse en un servidor."); return
+    level, normalize = guild_gain(config_store.get_guild(guild.id))
+    if setting is None:
+        await ctx.send(f"Volumen: **{level}%**, normalización de volumen {'activada' if normalize else 'desactivada'}."); return
+    setting = setting.strip().lower().rstrip('%')
+    if setting == 'auto': normalize = True
+    elif setting == 'fijo': normalize = False
+    elif setting.isdigit() and int(setting) <= VOLUME_MAX: level = int(setting)
+    else: await ctx.send(f"Uso: `!volume [0-{VOLUME_MAX}|auto|fijo]`"); return
+
+    config_store.update_guild(guild.id, volume=level, normalize_loudness=normalize)
+    vc = guild.voice_client
+    if vc and isinstance(vc.source, SharedStreamSource): vc.source.set_gain((level, normalize)) # Applies without restarting playback
+    await ctx.send(f"Volumen ajustado a **{level}%**, normalización de volumen {'activada' if normalize else 'desactivada'}.")
+
+@volume.error
+async def volume_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions): await ctx.send("No tienes permisos de Administrador.")
+    else: await ctx.send(f"Error en `volume`: {error}"); log.error("Error en volume: %s", error)
+
+@bot.command(name='stats')
+@commands.has_permissions(administrator=True)
+async def stats(ctx):
+    states = guild_registry.counts()
+    decoders = list(stream_hub.decoders.values())
+    running = decoder_supervisor.running()
+    open_circuits = sum(1 for b in stream_hub.breakers.values() if b.state != 'closed')
+    ttfa_count, ttfa_mean, ttfa_max = metrics.summary('streambot_time_to_first_audio_seconds')
+    lag_count, lag_mean, lag_max = metrics.summary('streambot_event_loop_lag_seconds')
+    _, load_mean, load_max = metrics.summary('streambot_config_load_seconds')
+    _, save_mean, save_max = metrics.summary('streambot_config_save_seconds')
+    _, sweep_mean, sweep_max = metrics.summary('streambot_reconcile_sweep_seconds')
+    command_count, command_mean, command_max = metrics.summary('streambot_command_seconds')
+    embed = discord.Embed(title="Estadísticas de StreamBot", color=discord.Color.blue())
+    embed.add_field(name="Servidores", value="\n".join(f"{state}: {states[state]}" for state in LIFECYCLE_STATES), inline=True)
+    embed.add_field(name="Streams", value=f"FFmpeg vivos: {len(running)} (standby: {len(stream_hub.standbys)})\nRSS FFmpeg: {sum(r.rss for r in running) / 2 ** 20:.0f} MB, CPU {sum(r.cpu_percent for r in running):.0f} %\nDecoders: {len(decoders)}\nCircuitos abiertos: {open_circuits}\nUnderruns: {sum(d.underruns for d in decoders)}", inline=True)
+    embed.add_field(name="Fallos", value=f"Reinicios: {metrics.total('streambot_guild_restarts_total'):.0f}\nErrores after_playing: {metrics.total('streambot_after_playing_errors_total'):.0f}\nReconexiones upstream: {metrics.total('streambot_decoder_reconnects_total'):.0f}\nFFmpeg colgados terminados: {metrics.total('streambot_ffmpeg_watchdog_kills_total'):.0f}", inline=True)
+    embed.add_field(name="Tiempo hasta audio", value=f"media {ttfa_mean:.2f} s, máx {ttfa_max:.2f} s ({ttfa_count} arranques)", inline=False)
+    embed.add_field(name="Lag del event loop", value=f"actual {loop_lag_monitor.last_lag * 1000:.1f} ms, media {lag_mean * 1000:.1f} ms, máx {lag_max * 1000:.1f} ms, bloqueos {metrics.total('streambot_event_loop_stalls_total'):.0f}", inline=False)
+    embed.add_field(name="Barrido de reconciliación", value=f"media {sweep_mean:.2f} s, máx {sweep_max:.2f} s, cola {len(reconciler.pending)}", inline=False)
+    embed.add_field(name="Comandos", value=f"media {command_mean * 1000:.0f} ms, máx {command_max * 1000:.0f} ms ({command_count} ejecutados)", inline=False)
+    embed.add_field(name="config.json", value=f"carga media {load_mean * 1000:.1f} ms (máx {load_max * 1000:.1f}), escritura media {save_mean * 1000:.1f} ms (máx {save_max * 1000:.1f})", inline=False)
+    shards = await coordinator_client.cluster_stats()
+    if shards:
+        cluster_states = defaultdict(int)
+        for shard in shards:
+            for state, count in shard['states'].items(): cluster_states[state] += count
+        embed.add_field(name=f"Clúster ({len(shards)} procesos)", value=(
+            f"Servidores: {sum(s['guilds'] for s in shards)} (reproduciendo: {cluster_states['playing']}, suspendidos: {cluster_states['suspended']})\n"
+            f"FFmpeg vivos: {sum(s['ffmpeg'] for s in shards)}\n"
+            f"Lag máx. del event loop: {max(s['loop_lag_ms'] for s in shards)} ms\n"
+            f"Procesos sin heartbeat: {sum(1 for s in shards if s.get('stale'))}"), inline=False)
+    await ctx.send(embed=embed)
+
+@stats.error
+async def stats_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions): await ctx.send("Necesitas permisos de Administrador.")
+    else: await ctx.send(f"Error en `!stats`: {error}"); log.error("Error en stats: %s", error)
+
+@bot.command(name='profile')
+@commands.has_permissions(administrator=True)
+async def profile(ctx, seconds: float = 30):
+    if profiler.running: return await ctx.send("Ya hay un perfil en curso (iniciado con `!profile` o SIGUSR1).")
+    seconds = min(max(seconds, 1), 300)
+    profiler.start()
+    await ctx.send(f"Perfilando el proceso durante {seconds:.0f} s...")
+    try: await asyncio.sleep(seconds)
+    finally: await asyncio.to_thread(profiler.stop)
+    top = "\n".join(f"`{share:6.1%}` {function}" for function, share in profiler.top_functions(5))
+    dump = discord.File(io.BytesIO(profiler.dump().encode()), filename=f"streambot-profile-{os.getpid()}.txt")
+    await ctx.send(f"Perfil de {profiler.samples} muestras. Funciones más activas:\n{top}", file=dump)
+
+@profile.error
+async def profile_error(ctx, error):
+    if isinstance(error, commands.MissingPermissions): await ctx.send("Necesitas permisos de Administrador.")
+    elif isinstance(error, commands.BadArgument): await ctx.send("Uso: `!profile [segundos]`")
+    else: await ctx.send(f"Error en `!profile`: {error}"); log.error("Error en profile: %s", error)
 
 @bot.command(name='help')
 async def help_command(ctx):
@@ -442,6 +2438,11 @@ async def help_command(ctx):
         value="Establece o actualiza la URL del stream de radio para este servidor. **(Solo Administradores)**\nLa URL global del archivo `.env` se usará si no se configura una específica.\n*Ejemplo: `!setstreamurl http://stream.example.com/mi_radio`*",
         inline=False
     )
+    embed.add_field(
+        name=f"`!volume [0-{VOLUME_MAX}|auto|fijo]`",
+        value="Muestra o ajusta el volumen de la radio en este servidor (por defecto 100). `auto` iguala el volumen entre canciones y emisoras, `fijo` lo desactiva. **(Solo Administradores)**\n*Ejemplo: `!volume 60`*",
+        inline=False
+    )
     embed.add_field(
         name="`!join`",
         value="Hace que el bot se una al canal de voz configurado y comience a reproducir la radio (usando la URL de stream del servidor o la global).",
@@ -452,6 +2453,16 @@ async def help_command(ctx):
         value="Hace que el bot se desconecte del canal de voz actual.",
         inline=False
     )
+    embed.add_field(
+        name="`!stats`",
+        value="Muestra el estado de reproducción, los streams y la salud del bot. **(Solo Administradores)**",
+        inline=False
+    )
+    embed.add_field(
+        name="`!profile [segundos]`",
+        value="Perfila el bot durante unos segundos (por defecto 30) y envía el resultado como archivo. **(Solo Administradores)**",
+        inline=False
+    )
     embed.add_field(
         name="`!ping`",
         value="Comprueba la latencia del bot.",
@@ -468,8 +2479,9 @@ async def help_command(ctx):
 if __name__ == "__main__":
     if DISCORD_TOKEN and RADIO_STREAM_URL != "YOUR_STREAM_URL_HERE": # Global fallback must be changed
         try: bot.run(DISCORD_TOKEN)
-        except discord.errors.PrivilegedIntentsRequired: print("Error: Intents privilegiados no habilitados.")
-        except Exception as e: print(f"Error al ejecutar bot: {e}")
+        except discord.errors.PrivilegedIntentsRequired: log.error("Intents privilegiados no habilitados.")
+        except Exception: log.exception("Error al ejecutar bot")
+        finally: config_store.flush_sync() # Persist any write still waiting in the write-behind buffer
     else:
-        if not DISCORD_TOKEN: print("Error: DISCORD_TOKEN no encontrado en .env.")
-        if RADIO_STREAM_URL == "YOUR_STREAM_URL_HERE": print("Error: Global RADIO_STREAM_URL no configurado en .env.")
+        if not DISCORD_TOKEN: log.error("DISCORD_TOKEN no encontrado en .env.")
+        if RADIO_STREAM_URL == "YOUR_STREAM_URL_HERE": log.error("Global RADIO_STREAM_URL no configurado en .env.")
@@ -0,0 +1,142 @@
+"""Runs StreamBot as several shard processes under a small local coordinator.
+
+Each process runs `bot.py` with a subset of the shards (SHARD_IDS out of SHARD_COUNT),
+owns only the guilds of those shards from config.json and keeps its own playback state.
+The coordinator listens on a Unix socket, restarts processes that exit or stop sending
+heartbeats, and answers cluster-wide !ping/!stats queries from each shard's last heartbeat.
+
+Usage: python launcher.py [--shards 8] [--processes 4]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import sys
+import tempfile
+import time
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+HEARTBEAT_TIMEOUT = 60 # Seconds without a heartbeat before a process is considered hung and restarted
+RESTART_BACKOFF_MAX = 60
+HEALTHY_SECONDS = 120 # A process that stayed up this long restarts without backoff
+IDENTIFY_SECONDS = 5 # Discord allows one shard identify per 5 s (max_concurrency 1) across every process
+
+
+class ShardProcess:
+    def __init__(self, index, shard_ids, shard_count, socket_path):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.socket_path = socket_path
+        self.process = None
+        self.started_at = 0.0
+        self.last_heartbeat = None
+        self.stats = None
+        self.failures = 0
+
+    @property
+    def label(self): return f"proceso {self.index} (shards {','.join(map(str, self.shard_ids))})"
+
+    async def spawn(self):
+        env = dict(os.environ, SHARD_COUNT=str(self.shard_count), SHARD_IDS=','.join(map(str, self.shard_ids)),
+                   COORDINATOR_SOCKET=self.socket_path)
+        if int(os.getenv('METRICS_PORT', '0')): env['METRICS_PORT'] = str(int(os.environ['METRICS_PORT']) + self.index) # One port per process
+        self.process = await asyncio.create_subprocess_exec(sys.executable, BOT_SCRIPT, env=env)
+        self.started_at = time.monotonic()
+        self.last_heartbeat = None
+        print(f"Coordinador: {self.label} iniciado (pid {self.process.pid}).")
+
+    def summary(self):
+        if self.stats is None: return None
+        stale = self.last_heartbeat is None or time.monotonic() - self.last_heartbeat > HEARTBEAT_TIMEOUT
+        return {**self.stats, 'stale': stale}
+
+
+class Coordinator:
+    def __init__(self, shard_count, process_count, socket_path):
+        self.socket_path = socket_path
+        # Round-robin so every process gets a similar share of shards (and guilds).
+        self.shards = [ShardProcess(i, list(range(i, shard_count, process_count)), shard_count, socket_path) for i in range(process_count)]
+        self.by_pid = {}
+        self.stopping = False
+        # Spawn processes one identify window apart: starting them together only makes them queue on
+        # the shared identify limit, and the last ones would take longest to send their first heartbeat.
+        self.spawn_stagger = IDENTIFY_SECONDS * -(-shard_count // process_count)
+
+    async def handle_connection(self, reader, writer):
+        shard = None
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                op = message.get('op')
+                if op == 'hello':
+                    shard = self.by_pid.get(message.get('pid'))
+                    if shard: shard.last_heartbeat = time.monotonic()
+                elif op == 'heartbeat' and shard:
+                    shard.last_heartbeat = time.monotonic()
+                    shard.stats = message.get('stats')
+                elif op == 'cluster_stats':
+                    shards = [s.summary() for s in self.shards]
+                    writer.write(json.dumps({'id': message.get('id'), 'shards': [s for s in shards if s]}).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, ValueError): pass
+        finally: writer.close()
+
+    async def supervise(self, shard):
+        await asyncio.sleep(shard.index * self.spawn_stagger)
+        while not self.stopping:
+            await shard.spawn()
+            self.by_pid[shard.process.pid] = shard
+            watchdog = asyncio.create_task(self.watchdog(shard))
+            code = await shard.process.wait()
+            watchdog.cancel()
+            self.by_pid.pop(shard.process.pid, None)
+            if self.stopping: return
+            uptime = time.monotonic() - shard.started_at
+            shard.failures = 0 if uptime >= HEALTHY_SECONDS else shard.failures + 1
+            delay = min(RESTART_BACKOFF_MAX, 2 ** shard.failures) * random.uniform(0.5, 1) if shard.failures else 0
+            print(f"Coordinador: {shard.label} terminó con código {code}. Reiniciando en {delay:.0f} s.")
+            await asyncio.sleep(delay)
+
+    async def watchdog(self, shard):
+        while True:
+            await asyncio.sleep(HEARTBEAT_TIMEOUT / 2)
+            since = shard.last_heartbeat or shard.started_at
+            if time.monotonic() - since > HEARTBEAT_TIMEOUT + (0 if shard.last_heartbeat else HEARTBEAT_TIMEOUT): # Extra time to log in
+                print(f"Coordinador: {shard.label} sin heartbeat. Reiniciando.")
+                shard.process.kill()
+                return
+
+    async def run(self):
+        if os.path.exists(self.socket_path): os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle_connection, self.socket_path)
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, self.stop)
+        try:
+            async with server:
+                await asyncio.gather(*(self.supervise(s) for s in self.shards))
+        finally:
+            if os.path.exists(self.socket_path): os.unlink(self.socket_path)
+
+    def stop(self):
+        self.stopping = True
+        for shard in self.shards:
+            if shard.process and shard.process.returncode is None: shard.process.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='Shard processes to run (default: one per core)')
+    parser.add_argument('--shards', type=int, default=None, help='Total Discord shards (default: same as --processes). Must be at least what Discord recommends (1 per 2,500 guilds)')
+    parser.add_argument('--socket', default=os.path.join(tempfile.gettempdir(), 'streambot-coordinator.sock'))
+    args = parser.parse_args()
+    shard_count = args.shards or args.processes
+    if shard_count < args.processes: parser.error("--shards no puede ser menor que --processes.")
+    print(f"Coordinador: {shard_count} shard(s) en {args.processes} proceso(s). Socket: {args.socket}")
+    asyncio.run(Coordinator(shard_count, args.processes, args.socket).run())
+
+
+if __name__ == '__main__':
+    main()